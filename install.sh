@@ -70,7 +70,7 @@ export DEBIAN_FRONTEND=noninteractive
 apt-get update -q
 
 PACKAGES=(
-  python3-pip python3-dev python3-gi python3-gi-cairo
+  python3-pip python3-dev python3-setuptools python3-gi python3-gi-cairo
   gir1.2-gtk-4.0 gir1.2-adw-1 gir1.2-glib-2.0
   libpam-python python3-pam
   cmake build-essential libopencv-dev
@@ -80,6 +80,7 @@ PACKAGES=(
   policykit-1
   libatlas-base-dev liblapack-dev libblas-dev
   libx11-dev libssl-dev
+  wget
 )
 
 apt-get install -y "${PACKAGES[@]}" 2>&1 | tail -5
@@ -88,13 +89,28 @@ success "System packages installed"
 # ── Python dependencies ──────────────────────────────────────
 step "Installing Python dependencies"
 
+# dlib's HOG detector and ResNet encoder are only vectorized when compiled
+# with AVX (x86) / NEON (ARM). Building from source lets dlib's CMake enable
+# whichever the host CPU supports; prebuilt wheels target a generic baseline.
+ARCH="$(uname -m)"
+case "${ARCH}" in
+  x86_64|i?86)
+    grep -qw avx /proc/cpuinfo || warn "CPU does not support AVX — dlib will be built without it"
+    ;;
+esac
+
 # face_recognition build can take a while (compiles dlib)
-info "Installing face_recognition (this may take 5–15 minutes — compiling dlib…)"
+info "Installing face_recognition (this may take 5–15 minutes — compiling dlib for ${ARCH}…)"
 echo
 
 PIP_LOG="$(mktemp)"
-pip3 install --break-system-packages face_recognition opencv-python \
-  >"${PIP_LOG}" 2>&1 &
+(
+  set -e
+  pip3 install --break-system-packages --no-binary dlib dlib
+  # dlib is already built above — don't let pip pull in a generic build
+  pip3 install --break-system-packages --no-deps face_recognition
+  pip3 install --break-system-packages face_recognition_models Click Pillow opencv-python
+) >"${PIP_LOG}" 2>&1 &
 PIP_PID=$!
 
 # ── Spinner ──────────────────────────────────────────────────
@@ -134,7 +150,9 @@ success "Python packages installed  (took ${TOTAL}s)"
 # ── Copy library files ───────────────────────────────────────
 step "Copying face unlock library files"
 cp "${SCRIPT_DIR}/src/face_engine/face_engine.py"  "${LIB_DIR}/"
+cp "${SCRIPT_DIR}/src/face_engine/cpu_affinity.py" "${LIB_DIR}/"
 cp "${SCRIPT_DIR}/src/face_engine/enroll.py"       "${LIB_DIR}/"
+cp "${SCRIPT_DIR}/src/face_engine/face_unlockd.py" "${LIB_DIR}/"
 cp "${SCRIPT_DIR}/src/pam/pam_face_unlock.py"      "${LIB_DIR}/"
 cp "${SCRIPT_DIR}/src/ui/face_unlock_ui.py"        "${LIB_DIR}/"
 cp "${SCRIPT_DIR}/src/ui/settings_app.py"          "${LIB_DIR}/"
@@ -147,6 +165,33 @@ chmod +x "${LIB_DIR}/toggle-guard.sh"
 cp "${SCRIPT_DIR}/src/ui/face-unlock-ui" /usr/local/bin/
 chmod +x /usr/local/bin/face-unlock-ui
 
+# DNN face detector used by the Guardian's presence check (falls back to Haar cascades)
+MODEL_DIR="${LIB_DIR}/models"
+mkdir -p "${MODEL_DIR}"
+
+# Download to a temp file and move it into place only if it looks complete,
+# so a failed wget never leaves a truncated model for OpenCV to choke on
+fetch_model() {  # url dest min_bytes
+  local tmp="${2}.part"
+  if wget -q -O "${tmp}" "$1" && [[ "$(stat -c %s "${tmp}")" -ge "$3" ]]; then
+    mv -f "${tmp}" "$2"
+  else
+    rm -f "${tmp}"
+    return 1
+  fi
+}
+
+if fetch_model "https://raw.githubusercontent.com/opencv/opencv_3rdparty/dnn_samples_face_detector_20180220_uint8/opencv_face_detector_uint8.pb" \
+     "${MODEL_DIR}/opencv_face_detector_uint8.pb" 2000000 \
+   && fetch_model "https://raw.githubusercontent.com/opencv/opencv/4.x/samples/dnn/face_detector/opencv_face_detector.pbtxt" \
+     "${MODEL_DIR}/opencv_face_detector.pbtxt" 10000; then
+  chmod 644 "${MODEL_DIR}/"*
+else
+  # One file without the other is useless: remove both so the Haar fallback is deliberate
+  rm -f "${MODEL_DIR}/opencv_face_detector_uint8.pb" "${MODEL_DIR}/opencv_face_detector.pbtxt"
+  warn "Could not download the DNN face detector — Guardian will use Haar cascades"
+fi
+
 # ── Lock Face settings app (.desktop entry) ──────────────────
 cat > "${DESKTOP_DIR}/face-unlock.desktop" << 'DESKTOP'
 [Desktop Entry]
@@ -168,6 +213,15 @@ cp "${LIB_DIR}/pam_face_unlock.py" /lib/security/pam_face_unlock.py
 chmod 644 /lib/security/pam_face_unlock.py
 success "PAM module installed"
 
+# ── Face engine daemon ───────────────────────────────────────
+step "Installing face engine daemon"
+cp "${SCRIPT_DIR}/src/face_engine/face-unlockd.socket"  /etc/systemd/system/
+cp "${SCRIPT_DIR}/src/face_engine/face-unlockd.service" /etc/systemd/system/
+systemctl daemon-reload
+systemctl enable --now face-unlockd.socket 2>/dev/null || \
+  warn "Could not enable face-unlockd.socket — PAM will start the engine per attempt"
+success "Daemon socket listening on /run/face-unlock.sock"
+
 # ── PAM configuration ────────────────────────────────────────
 step "Configuring PAM (backing up originals)"
 
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""
+Face Unlock — CPU Affinity
+Opt-in pinning shared by the face engine and the guardian. Importing this
+module has no side effects; call pin_to_cpu() early in the process.
+"""
+
+import os
+import logging
+
+log = logging.getLogger("cpu_affinity")
+
+CPU_AFFINITY = os.environ.get("FACE_UNLOCK_CPU", "")   # e.g. "0" or "4" (big core on big.LITTLE)
+
+def pin_to_cpu():
+    """
+    Pin the process to FACE_UNLOCK_CPU (opt-in). HOG and the encoder are
+    single-threaded, so keeping them on one core avoids cache-cold migrations.
+    Threads that already exist (numpy's BLAS pool starts on import) are pinned
+    one by one; threads started later inherit the mask.
+    """
+    if not CPU_AFFINITY:
+        return
+    try:
+        cpus = {int(c) for c in CPU_AFFINITY.split(",")}
+        for tid in os.listdir("/proc/self/task"):
+            os.sched_setaffinity(int(tid), cpus)
+        log.debug(f"Pinned to CPU(s) {sorted(cpus)}")
+    except (ValueError, OSError, AttributeError) as e:
+        log.warning(f"Ignoring FACE_UNLOCK_CPU={CPU_AFFINITY!r}: {e}")
@@ -11,6 +11,7 @@ import time
 import getpass
 import argparse
 import logging
+import heapq
 
 # Ensure root can open GTK/Qt windows when running via sudo
 if os.geteuid() == 0:
@@ -30,8 +31,14 @@ if os.geteuid() == 0:
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 log = logging.getLogger("enroll")
 
-SAMPLES_NEEDED = 15
+SAMPLES_NEEDED = 25
 CAMERA_INDEX   = int(os.environ.get("FACE_UNLOCK_CAMERA", "0"))
+REFINE_SAMPLES = 5     # largest-face samples re-encoded with jitter at the end
+REFINE_JITTERS = 10
+DUPLICATE_SIMILARITY = 0.98  # reject samples this close (cosine) to the previous one
+MIN_CENTER_SPREAD    = 10    # px; std-dev of face x-centres needed to finish
+SPREAD_TIMEOUT       = 15    # s after the last sample to reach the spread before saving anyway
+CAPTURE_TIMEOUT      = 120   # s to collect all samples before giving up
 
 def print_banner():
     print("\n")
@@ -44,12 +51,13 @@ def enroll_user(username: str, camera_idx: int = CAMERA_INDEX) -> bool:
     try:
         import face_recognition
         import cv2
+        import numpy as np
     except ImportError as e:
         print(f"❌ Missing dependency: {e}")
         print("   Run: sudo pip3 install face_recognition opencv-python")
         return False
 
-    from face_engine import save_encodings
+    from face_engine import save_encodings, request_camera, end_camera_request, open_camera
 
     print(f"  👤 Enrolling face for user: {username}")
     print(f"  📷 Using camera: /dev/video{camera_idx}")
@@ -58,50 +66,79 @@ def enroll_user(username: str, camera_idx: int = CAMERA_INDEX) -> bool:
     print("  • Look directly at the camera at first")
     print("  • Slowly turn your head SIDE TO SIDE (Profile Views)")
     print("  • Slowly look UP and DOWN")
+    print("  • Keep moving: samples too similar to the last one are skipped")
     print("  • Keep good lighting on your face")
     print("  • Stay within 30–80cm of the camera")
     print()
 
     input("  Press ENTER when ready to start enrollment... ")
 
-    cap = cv2.VideoCapture(camera_idx)
-    if not cap.isOpened():
+    # Takes the camera over from the guardian if it is running
+    request_camera()
+    cap = open_camera(cv2, camera_idx)
+    if cap is None:
+        end_camera_request()
         print(f"❌ Cannot open camera at index {camera_idx}")
         return False
 
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-
     collected_encodings = []
+    best_samples = []      # min-heap of (face_area, sample_idx, rgb_frame, location)
+    x_centers = []         # horizontal face position of each sample (pose diversity)
     frame_count = 0
     sample_count = 0
+    rgb_frame = None       # allocated once, then filled in place by cvtColor
     last_sample_time = 0
+    last_duplicate_time = 0
+    spread_deadline = None # set once SAMPLES_NEEDED is reached
 
     print(f"\n  📸 Capturing {SAMPLES_NEEDED} face samples...")
     print()
 
     window_name = "Face Unlock — Enrollment (press Q to abort)"
+    cv2.namedWindow(window_name, cv2.WND_PROP_FULLSCREEN)
+    cv2.setWindowProperty(window_name, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
+
+    # Full white screen to illuminate the face. Allocated once: each frame only
+    # overwrites the centre, the white border never changes.
+    screen_h, screen_w = 1080, 1920
+    white_canvas = np.full((screen_h, screen_w, 3), 255, dtype=np.uint8)
 
+    start_time = time.time()
     try:
-        while sample_count < SAMPLES_NEEDED:
+        while True:
+            now = time.time()
+            if sample_count >= SAMPLES_NEEDED:
+                if np.std(x_centers) >= MIN_CENTER_SPREAD:
+                    break
+                if spread_deadline is None:
+                    spread_deadline = now + SPREAD_TIMEOUT
+                elif now >= spread_deadline:
+                    print("\n  ⚠️  Little head movement detected — saving the samples anyway.")
+                    print("     Re-enroll later if recognition is unreliable at an angle.")
+                    break
+            elif now - start_time > CAPTURE_TIMEOUT:
+                print(f"\n  ❌ Timed out after {CAPTURE_TIMEOUT}s waiting for face samples.")
+                break
+
             ret, frame = cap.read()
             if not ret:
                 continue
 
             frame_count += 1
-            import numpy as np
-            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            rgb_frame = np.ascontiguousarray(rgb_frame, dtype=np.uint8)
+            if rgb_frame is None or rgb_frame.shape != frame.shape:
+                rgb_frame = np.empty_like(frame)
+            cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=rgb_frame)
 
-            # Detect faces
-            face_locations = face_recognition.face_locations(rgb_frame, model="hog")
+            # Detect faces. Enrollees sit 30–80cm away, so faces are far larger than
+            # HOG's 80px window and the extra upsampled pyramid level is wasted work.
+            face_locations = face_recognition.face_locations(rgb_frame, number_of_times_to_upsample=0, model="hog")
 
             # Draw UI on frame
             display_frame = frame.copy()
             height, width = frame.shape[:2]
 
             # Progress bar
-            progress = sample_count / SAMPLES_NEEDED
+            progress = min(1.0, sample_count / SAMPLES_NEEDED)
             bar_width = int(width * 0.8)
             bar_x = int(width * 0.1)
             bar_y = height - 40
@@ -109,6 +146,12 @@ def enroll_user(username: str, camera_idx: int = CAMERA_INDEX) -> bool:
             cv2.rectangle(display_frame, (bar_x, bar_y), (bar_x + int(bar_width * progress), bar_y + 20), (0, 200, 100), -1)
             cv2.putText(display_frame, f"Samples: {sample_count}/{SAMPLES_NEEDED}",
                        (bar_x, bar_y - 8), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+            if spread_deadline is not None:
+                cv2.putText(display_frame, f"Turn your head side to side ({int(spread_deadline - now)}s)",
+                           (bar_x, 40), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 165, 255), 2)
+            elif now - last_duplicate_time < 1.0:
+                cv2.putText(display_frame, "Move your head a little",
+                           (bar_x, 40), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 165, 255), 2)
 
             for (top, right, bottom, left) in face_locations:
                 # Draw face box
@@ -123,25 +166,38 @@ def enroll_user(username: str, camera_idx: int = CAMERA_INDEX) -> bool:
                     now - last_sample_time >= 0.5 and
                     frame_count > 5):
 
-                # Use the single-arg form — avoids dlib API version mismatches
-                face_encodings = face_recognition.face_encodings(rgb_frame, num_jitters=100, model="large")
+                # Single forward pass per live frame; the best samples get
+                # re-encoded with jitter once capture is done.
+                face_encodings = face_recognition.face_encodings(rgb_frame, face_locations, num_jitters=1, model="large")
+                if face_encodings and collected_encodings:
+                    # Skip near-duplicates of the previous sample (user didn't move)
+                    last, encoding = collected_encodings[-1], face_encodings[0]
+                    similarity = np.dot(last, encoding) / (np.linalg.norm(last) * np.linalg.norm(encoding))
+                    if similarity > DUPLICATE_SIMILARITY:
+                        face_encodings = []
+                        last_sample_time = now
+                        last_duplicate_time = now
+
                 if face_encodings:
+                    top, right, bottom, left = face_locations[0]
+                    sample = ((bottom - top) * (right - left), len(collected_encodings),
+                              rgb_frame.copy(), face_locations[0])
+                    if len(best_samples) < REFINE_SAMPLES:
+                        heapq.heappush(best_samples, sample)
+                    else:
+                        heapq.heappushpop(best_samples, sample)
+
                     collected_encodings.append(face_encodings[0])
+                    x_centers.append((left + right) / 2)
                     sample_count += 1
                     last_sample_time = now
                     log.info(f"  ✅ Sample {sample_count}/{SAMPLES_NEEDED} captured")
 
-            # Create full white screen to illuminate face
-            screen_h, screen_w = 1080, 1920
-            white_canvas = np.ones((screen_h, screen_w, 3), dtype=np.uint8) * 255
-            
             # Embed frame into center of canvas
             y_offset = (screen_h - height) // 2
             x_offset = (screen_w - width) // 2
             white_canvas[y_offset:y_offset+height, x_offset:x_offset+width] = display_frame
 
-            cv2.namedWindow(window_name, cv2.WND_PROP_FULLSCREEN)
-            cv2.setWindowProperty(window_name, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
             cv2.imshow(window_name, white_canvas)
 
             key = cv2.waitKey(1) & 0xFF
@@ -151,12 +207,21 @@ def enroll_user(username: str, camera_idx: int = CAMERA_INDEX) -> bool:
 
     finally:
         cap.release()
+        end_camera_request()
         cv2.destroyAllWindows()
 
     if len(collected_encodings) < SAMPLES_NEEDED:
         print(f"\n  ❌ Only captured {len(collected_encodings)} samples. Enrollment failed.")
         return False
 
+    # Re-encode the largest (sharpest) faces with jitter for more robust embeddings
+    print(f"\n  ✨ Refining {len(best_samples)} best samples...")
+    for _, idx, sample_frame, location in best_samples:
+        refined = face_recognition.face_encodings(sample_frame, [location],
+                                                  num_jitters=REFINE_JITTERS, model="large")
+        if refined:
+            collected_encodings[idx] = refined[0]
+
     # Save encodings
     print(f"\n  💾 Saving face data...")
     save_encodings(username, collected_encodings)
@@ -166,10 +231,12 @@ def enroll_user(username: str, camera_idx: int = CAMERA_INDEX) -> bool:
     return True
 
 def delete_enrollment(username: str) -> bool:
-    from face_engine import get_encoding_path
-    path = get_encoding_path(username)
-    if path.exists():
-        path.unlink()
+    from face_engine import get_encoding_path, get_centroid_path, get_legacy_encoding_path
+    paths = [p for p in (get_encoding_path(username), get_centroid_path(username),
+                         get_legacy_encoding_path(username)) if p.exists()]
+    if paths:
+        for path in paths:
+            path.unlink()
         print(f"✅ Removed face data for '{username}'")
         return True
     else:
@@ -183,7 +250,7 @@ def main():
     parser.add_argument("--user", default=None, help="Username to enroll (default: current user)")
     parser.add_argument("--camera", type=int, default=CAMERA_INDEX, help="Camera device index")
     parser.add_argument("--delete", action="store_true", help="Delete enrolled face for user")
-    parser.add_argument("--samples", type=int, default=10, help="Number of samples to capture")
+    parser.add_argument("--samples", type=int, default=SAMPLES_NEEDED, help="Number of samples to capture")
     args = parser.parse_args()
 
     username = args.user or os.environ.get("SUDO_USER") or getpass.getuser()
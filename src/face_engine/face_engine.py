@@ -7,8 +7,11 @@ Core face recognition module using OpenCV + face_recognition (dlib)
 import os
 import sys
 import time
+import queue
 import pickle
 import logging
+import platform
+import threading
 import numpy as np
 from enum import Enum
 from pathlib import Path
@@ -30,6 +33,57 @@ MAX_ATTEMPTS    = int(os.environ.get("FACE_UNLOCK_ATTEMPTS", "20"))   # frames t
 TIMEOUT_SECONDS = float(os.environ.get("FACE_UNLOCK_TIMEOUT", "8.0"))
 FRAME_WIDTH     = 640
 FRAME_HEIGHT    = 480
+DETECT_DOWNSCALE = 2   # HOG runs on a frame this many times smaller per side
+MIN_EYE_DISTANCE = float(os.environ.get("FACE_UNLOCK_MIN_EYE_DISTANCE", "40"))  # px at 640x480
+MIN_FACE_BRIGHTNESS = 40          # mean intensity (0-255) of the face chip
+FACE_ASPECT_RANGE = (0.6, 1.6)    # plausible width/height of a HOG face box
+# While this file exists the guardian keeps its hands off the camera
+CAMERA_REQUEST_PATH = Path("/run/face-unlock/camera-request")
+CAMERA_HANDOFF_TIMEOUT = 1.5      # seconds to wait for the guardian to let go of the camera
+
+# ─── CPU Affinity ─────────────────────────────────────────────────────────────
+# Before the Numba warm-up below starts its thread pool, so every thread is pinned
+
+from cpu_affinity import pin_to_cpu
+pin_to_cpu()
+
+# ─── Optional Numba Kernels ───────────────────────────────────────────────────
+# With numba installed, the per-frame channel swap and the centroid score run as
+# compiled SIMD loops; otherwise cv2/numpy are used. The two can't be fused into
+# one pass because the probe only exists after the RGB frame has been encoded.
+
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+if HAS_NUMBA:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _bgr_to_rgb(frame, out):
+        for y in prange(frame.shape[0]):
+            for x in range(frame.shape[1]):
+                out[y, x, 0] = frame[y, x, 2]
+                out[y, x, 1] = frame[y, x, 1]
+                out[y, x, 2] = frame[y, x, 0]
+
+    @njit(fastmath=True, cache=True)
+    def centroid_score(centroid, probe):
+        """Cosine similarity between the unit centroid and a raw probe encoding."""
+        dot = 0.0
+        norm_sq = 0.0
+        for i in range(probe.shape[0]):
+            dot += centroid[i] * probe[i]
+            norm_sq += probe[i] * probe[i]
+        return dot / np.sqrt(norm_sq)
+
+    # Compile now (or load from the on-disk cache) so the JIT never runs mid-scan
+    _bgr_to_rgb(np.zeros((2, 2, 3), np.uint8), np.empty((2, 2, 3), np.uint8))
+    centroid_score(np.zeros(128, np.float32), np.ones(128, np.float64))
+else:
+    def centroid_score(centroid, probe):
+        """Cosine similarity between the unit centroid and a raw probe encoding."""
+        return float(centroid @ probe) / float(np.linalg.norm(probe))
 
 class AuthResult(Enum):
     MATCH        = "match"
@@ -38,77 +92,288 @@ class AuthResult(Enum):
     CAMERA_ERROR = "camera_error"
     NO_ENCODINGS = "no_encodings"
     TIMEOUT      = "timeout"
+    CANCELLED    = "cancelled"
+
+# ─── dlib Build Check ─────────────────────────────────────────────────────────
+
+def check_dlib_build():
+    """
+    Warn when dlib was compiled without SIMD support.
+    HOG detection and the ResNet encoder run 5–30x slower without AVX (x86)
+    or NEON (ARM), and nothing else reports it.
+    """
+    try:
+        import dlib
+    except ImportError:
+        return  # reported by authenticate()
+
+    log.debug(f"dlib {getattr(dlib, '__version__', '?')}, "
+              f"CUDA={getattr(dlib, 'DLIB_USE_CUDA', False)}")
+
+    machine = platform.machine().lower()
+    if machine in ("x86_64", "amd64", "i386", "i686"):
+        flag, simd = "USE_AVX_INSTRUCTIONS", "AVX"
+    elif machine.startswith(("arm", "aarch64")):
+        flag, simd = "USE_NEON_INSTRUCTIONS", "NEON"
+    else:
+        return
+
+    enabled = getattr(dlib, flag, None)
+    if enabled is None:
+        log.debug(f"dlib does not report {flag}; cannot verify {simd} support")
+    elif not enabled:
+        log.warning(f"dlib was built without {simd} — face recognition will be slow. "
+                    f"Re-run install.sh to rebuild dlib with {simd} enabled.")
+
+check_dlib_build()
 
 # ─── Encoding Storage ─────────────────────────────────────────────────────────
 
 def get_encoding_path(username: str) -> Path:
+    """Enrolled samples: an (N, 128) float16 .npy matrix."""
+    return ENCODINGS_DIR / f"{username}.npy"
+
+def get_centroid_path(username: str) -> Path:
+    return ENCODINGS_DIR / f"{username}.centroid.npy"
+
+def get_legacy_encoding_path(username: str) -> Path:
+    """Pickle written by older versions; still read until the user re-enrolls."""
     return ENCODINGS_DIR / f"{username}.pkl"
 
+def compute_centroid(encodings: np.ndarray) -> np.ndarray:
+    """L2-normalized mean of the enrolled samples, used on the hot path."""
+    centroid = np.mean(encodings, axis=0, dtype=np.float32)
+    return (centroid / np.linalg.norm(centroid)).astype(np.float32)
+
+def _save_array(path: Path, array: np.ndarray, username: str):
+    """
+    Write an .npy next to its final path and rename it into place. The guardian
+    and the daemon memory-map these files, so rewriting them in place could
+    SIGBUS a reader or hand it a half-written header.
+    """
+    import shutil
+    import tempfile
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, array)
+        # Secure the file: owned by the user so the guardian service can read it,
+        # but chmod 600 so other users cannot.
+        try:
+            shutil.chown(tmp_path, user=username)
+        except Exception as e:
+            log.warning(f"Could not chown {path} to {username}: {e}")
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
 def save_encodings(username: str, encodings: list) -> bool:
     ENCODINGS_DIR.mkdir(parents=True, exist_ok=True)
-    path = get_encoding_path(username)
-    with open(path, "wb") as f:
-        pickle.dump(encodings, f)
-    
-    # Secure the file: make it owned by the user so the guardian service can read it,
-    # but keep it chmod 600 so other users cannot read it.
-    try:
-        import shutil
-        shutil.chown(path, user=username)
-    except Exception as e:
-        log.warning(f"Could not chown {path} to {username}: {e}")
-    
-    os.chmod(path, 0o600)
+    # Keep the raw (N, 128) samples for re-enrollment; authentication only
+    # needs the centroid. dlib embeddings carry ~3 significant digits, so the
+    # samples are stored as float16 (half the size and memory traffic).
+    encodings = np.asarray(encodings, dtype=np.float32)
+    _save_array(get_encoding_path(username), encodings.astype(np.float16), username)
+    _save_array(get_centroid_path(username), compute_centroid(encodings), username)
+
+    # Drop the old-format pickle so stale data doesn't linger
+    get_legacy_encoding_path(username).unlink(missing_ok=True)
     log.info(f"Saved {len(encodings)} encodings for user '{username}'")
     return True
 
-def load_encodings(username: str) -> list:
+def load_enrollment(username: str) -> dict:
+    """
+    Return {"encodings": (N, 128) float16 matrix, "centroid": (128,) float32 unit vector}.
+    centroid is None when nothing is enrolled.
+
+    The .npy files are memory-mapped: loading returns immediately and the page
+    cache keeps them hot between authentications.
+    """
     path = get_encoding_path(username)
-    if not path.exists():
+    legacy_path = get_legacy_encoding_path(username)
+
+    if path.exists():
+        encodings = np.load(path, mmap_mode="r")
+        centroid_path = get_centroid_path(username)
+        if centroid_path.exists():
+            centroid = np.load(centroid_path)  # 512 bytes, read outright
+        else:
+            centroid = compute_centroid(encodings) if len(encodings) else None
+    elif legacy_path.exists():
+        with open(legacy_path, "rb") as f:
+            data = pickle.load(f)
+        if isinstance(data, dict):
+            encodings = np.asarray(data["encodings"], dtype=np.float16)
+            centroid = np.asarray(data["centroid"], dtype=np.float32)
+        else:
+            # Oldest enrollments pickled just the float64 samples (list or matrix)
+            samples = np.asarray(data, dtype=np.float32)
+            encodings = samples.astype(np.float16)
+            centroid = compute_centroid(samples) if len(samples) else None
+    else:
         log.warning(f"No encodings found for user '{username}'")
-        return []
-    with open(path, "rb") as f:
-        encodings = pickle.load(f)
+        return {"encodings": np.empty((0, 128), dtype=np.float16), "centroid": None}
+
     log.info(f"Loaded {len(encodings)} encodings for user '{username}'")
-    return encodings
+    return {"encodings": encodings, "centroid": centroid}
+
+def load_encodings(username: str) -> np.ndarray:
+    """Return the enrolled encodings as an (N, 128) float16 matrix."""
+    return load_enrollment(username)["encodings"]
 
 # ─── Face Recognition ─────────────────────────────────────────────────────────
 
-def authenticate(username: str, progress_callback=None) -> AuthResult:
+def fourcc_name(value: float) -> str:
+    """Decode CAP_PROP_FOURCC (returned as a float) into e.g. 'MJPG'."""
+    code = int(value)
+    return "".join(chr((code >> (8 * i)) & 0xFF) for i in range(4))
+
+def scale_locations(locations: list, factor: int) -> list:
+    """Scale (top, right, bottom, left) boxes found on a downscaled frame."""
+    return [(top * factor, right * factor, bottom * factor, left * factor)
+            for (top, right, bottom, left) in locations]
+
+def request_camera():
+    """
+    Ask the face guardian for the camera. It keeps the device open while
+    guarding and closes it within a fraction of a second once the request
+    file appears. Pair with end_camera_request().
+    """
+    try:
+        CAMERA_REQUEST_PATH.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+        CAMERA_REQUEST_PATH.touch()
+    except OSError as e:
+        log.debug(f"Could not post camera request: {e}")
+
+def end_camera_request():
+    try:
+        CAMERA_REQUEST_PATH.unlink(missing_ok=True)
+    except OSError:
+        pass
+
+def open_camera(cv2, index: int):
+    """
+    Open the camera and read one frame, retrying while the guardian hands it
+    over. Returns the capture device, or None if it never became usable.
+    """
+    deadline = time.time() + CAMERA_HANDOFF_TIMEOUT
+    while True:
+        cap = cv2.VideoCapture(index)
+        if cap.isOpened():
+            # Request MJPG before the size: raw YUYV at 640x480 saturates USB 2.0 and
+            # caps most UVC cameras well below 30fps. OpenCV decodes it with libjpeg-turbo.
+            cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+            cap.set(cv2.CAP_PROP_FRAME_WIDTH, FRAME_WIDTH)
+            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, FRAME_HEIGHT)
+            # A busy V4L2 device can open fine and only fail once streaming starts
+            if cap.read()[0]:
+                return cap
+        cap.release()
+        if time.time() >= deadline:
+            return None
+        time.sleep(0.1)
+
+def _capture_frames(cap, frames: queue.Queue, stop: threading.Event):
+    """
+    Camera reader thread.
+    Keeps only the newest frame in the 1-slot queue, so inference overlaps with
+    the USB/V4L2 transfer of the next frame and never works on a stale one.
+    """
+    while not stop.is_set():
+        ret, frame = cap.read()
+        if not ret:
+            log.warning("Failed to read camera frame")
+            time.sleep(0.1)
+            continue
+        try:
+            frames.get_nowait()  # drop the frame inference didn't get to
+        except queue.Empty:
+            pass
+        frames.put_nowait(frame)
+
+def is_plausible_face(rgb_frame, location, pose_predictor, dlib) -> bool:
+    """
+    Cheap pre-filter run before the ResNet encoder (~3ms vs ~20ms per face).
+    Rejects boxes with an odd shape, faces in deep shadow and faces too far
+    from the camera to give a reliable encoding.
+    """
+    top, right, bottom, left = location
+    width, height = right - left, bottom - top
+    if height <= 0 or not FACE_ASPECT_RANGE[0] <= width / height <= FACE_ASPECT_RANGE[1]:
+        return False
+
+    chip = rgb_frame[max(top, 0):bottom, max(left, 0):right]
+    if chip.size == 0 or chip.mean() < MIN_FACE_BRIGHTNESS:
+        return False
+
+    # 5-point model: parts 0-1 and 2-3 are the corners of each eye, 4 is the nose
+    shape = pose_predictor(rgb_frame, dlib.rectangle(left, top, right, bottom))
+    eye_a = np.array([(shape.part(0).x + shape.part(1).x) / 2, (shape.part(0).y + shape.part(1).y) / 2])
+    eye_b = np.array([(shape.part(2).x + shape.part(3).x) / 2, (shape.part(2).y + shape.part(3).y) / 2])
+    return float(np.linalg.norm(eye_a - eye_b)) >= MIN_EYE_DISTANCE
+
+def encode_faces(rgb_frame, locations, num_jitters, dlib, fr_api) -> list:
+    """
+    Batched replacement for face_recognition.face_encodings(model="large").
+    The wrapper runs the ResNet once per face; handing dlib all 68-point shapes
+    at once pushes them through the network as a single mini-batch.
+    """
+    shapes = dlib.full_object_detections()
+    for top, right, bottom, left in locations:
+        shapes.append(fr_api.pose_predictor_68_point(rgb_frame, dlib.rectangle(left, top, right, bottom)))
+    descriptors = fr_api.face_encoder.compute_face_descriptor(rgb_frame, shapes, num_jitters)
+    return [np.array(d) for d in descriptors]
+
+def authenticate(username: str, progress_callback=None, should_abort=None) -> AuthResult:
     """
     Main authentication function.
     Opens camera, tries to match face against enrolled encodings.
     Returns AuthResult enum value.
 
     progress_callback(state: str, data: dict) — optional live updates
+    should_abort() — optional, checked every frame; True stops the scan (CANCELLED)
     """
     try:
+        import dlib
         import face_recognition
         import cv2
+        from face_recognition import api as fr_api
     except ImportError as e:
         log.error(f"Missing dependency: {e}")
         return AuthResult.CAMERA_ERROR
 
-    # Load enrolled face encodings
-    known_encodings = load_encodings(username)
-    if not known_encodings:
+    # Load enrolled face centroid
+    centroid = load_enrollment(username)["centroid"]
+    if centroid is None:
         return AuthResult.NO_ENCODINGS
 
-    # Open camera
-    cap = cv2.VideoCapture(CAMERA_INDEX)
-    if not cap.isOpened():
+    # For unit vectors |a - b|² = 2 - 2·cos(a, b), so the Euclidean tolerance
+    # maps directly onto a cosine-similarity threshold
+    cos_threshold = 1.0 - CONFIDENCE_THRESHOLD ** 2 / 2
+
+    # Open camera, taking it over from the guardian if it holds it
+    request_camera()
+    cap = open_camera(cv2, CAMERA_INDEX)
+    if cap is None:
+        end_camera_request()
         log.error(f"Cannot open camera at index {CAMERA_INDEX}")
         return AuthResult.CAMERA_ERROR
-
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, FRAME_WIDTH)
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, FRAME_HEIGHT)
     cap.set(cv2.CAP_PROP_FPS, 30)
+    log.debug(f"Camera pixel format: {fourcc_name(cap.get(cv2.CAP_PROP_FOURCC))}")
 
     if progress_callback:
         progress_callback("scanning", {})
 
+    frames = queue.Queue(maxsize=1)
+    stop = threading.Event()
+    grabber = threading.Thread(target=_capture_frames, args=(cap, frames, stop), daemon=True)
+    grabber.start()
+
     start_time = time.time()
-    frame_count = 0
+    rgb_frame = None   # allocated once, then filled in place each frame
+    small_frame = None # downscaled copy used for face detection
     result = AuthResult.TIMEOUT
 
     try:
@@ -119,47 +384,64 @@ def authenticate(username: str, progress_callback=None) -> AuthResult:
                 log.info("Face unlock timed out")
                 result = AuthResult.TIMEOUT
                 break
+            if should_abort and should_abort():
+                log.info("Face unlock cancelled by the caller")
+                result = AuthResult.CANCELLED
+                break
 
-            ret, frame = cap.read()
-            if not ret:
-                log.warning("Failed to read camera frame")
-                time.sleep(0.1)
+            # Frames that arrive while we're busy are dropped by the grabber
+            try:
+                frame = frames.get(timeout=0.5)
+            except queue.Empty:
                 continue
 
-            frame_count += 1
+            # Convert BGR (OpenCV) → RGB (face_recognition) into the reused buffer
+            if rgb_frame is None or rgb_frame.shape != frame.shape:
+                rgb_frame = np.empty_like(frame)
+                height, width = frame.shape[:2]
+                small_frame = np.empty((height // DETECT_DOWNSCALE, width // DETECT_DOWNSCALE, 3),
+                                       dtype=np.uint8)
+            if HAS_NUMBA:
+                _bgr_to_rgb(frame, rgb_frame)
+            else:
+                cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=rgb_frame)
+
+            # Detect face locations on the downscaled frame (use 'hog' for CPU, 'cnn' for GPU).
+            # HOG cost is roughly linear in pixel count; the encoder still gets the
+            # full-resolution frame so its face chips keep their detail.
+            cv2.resize(rgb_frame, (small_frame.shape[1], small_frame.shape[0]),
+                       dst=small_frame, interpolation=cv2.INTER_AREA)
+            face_locations = scale_locations(
+                face_recognition.face_locations(small_frame, number_of_times_to_upsample=1, model="hog"),
+                DETECT_DOWNSCALE
+            )
 
-            # Process every 2nd frame for performance
-            if frame_count % 2 != 0:
+            if not face_locations:
+                log.debug("No face detected in frame")
+                if progress_callback:
+                    progress_callback("no_face", {"elapsed": elapsed})
                 continue
 
-            # Convert BGR (OpenCV) → RGB (face_recognition)
-            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            rgb_frame = np.ascontiguousarray(rgb_frame, dtype=np.uint8)
-
-            # Detect face locations (use 'hog' for CPU, 'cnn' for GPU)
-            face_locations = face_recognition.face_locations(rgb_frame, model="hog")
-
+            # Only faces that pass the landmark pre-check reach the ResNet encoder
+            face_locations = [loc for loc in face_locations
+                              if is_plausible_face(rgb_frame, loc, fr_api.pose_predictor_5_point, dlib)]
             if not face_locations:
-                log.debug("No face detected in frame")
+                log.debug("Face rejected by pre-check (too far, too dark or badly framed)")
                 if progress_callback:
                     progress_callback("no_face", {"elapsed": elapsed})
                 continue
 
-            # Encode detected faces
-            face_encodings = face_recognition.face_encodings(rgb_frame, face_locations, num_jitters=2, model="large")
+            # Encode all remaining faces in one ResNet batch
+            face_encodings = encode_faces(rgb_frame, face_locations, 2, dlib, fr_api)
 
             for face_encoding in face_encodings:
-                # Compare with known encodings
-                distances = face_recognition.face_distance(known_encodings, face_encoding)
-                min_distance = np.min(distances)
-                matches = face_recognition.compare_faces(
-                    known_encodings, face_encoding,
-                    tolerance=CONFIDENCE_THRESHOLD
-                )
+                # Compare with the enrolled centroid: a single 128-D dot product
+                score = float(centroid_score(centroid, face_encoding))
+                min_distance = np.sqrt(max(0.0, 2.0 - 2.0 * score))
 
-                log.debug(f"Min distance: {min_distance:.3f}, Threshold: {CONFIDENCE_THRESHOLD}")
+                log.debug(f"Distance: {min_distance:.3f}, Threshold: {CONFIDENCE_THRESHOLD}")
 
-                if any(matches):
+                if score >= cos_threshold:
                     confidence = 1.0 - min_distance
                     log.info(f"Face MATCHED! Confidence: {confidence:.1%}")
                     if progress_callback:
@@ -175,7 +457,10 @@ def authenticate(username: str, progress_callback=None) -> AuthResult:
                 break
 
     finally:
+        stop.set()
+        grabber.join(timeout=2.0)
         cap.release()
+        end_camera_request()
 
     return result
 
@@ -183,6 +468,11 @@ def authenticate(username: str, progress_callback=None) -> AuthResult:
 
 def main():
     import argparse
+    import signal
+    # PAM sends SIGTERM on cancel or timeout (SIGKILL only if that doesn't work
+    # within a second): exit through the finally blocks so the camera and the
+    # guardian hand-off request are released
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
     parser = argparse.ArgumentParser(description="Face Unlock Engine")
     parser.add_argument("--user", default=os.environ.get("USER", "root"),
                         help="Username to authenticate")
@@ -193,6 +483,8 @@ def main():
     parser.add_argument("--camera", type=int, default=CAMERA_INDEX,
                         help="Camera device index")
     parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--result-fd", type=int, default=None,
+                        help="Also write just the result value to this fd (used by the PAM module)")
     args = parser.parse_args()
 
     if args.verbose:
@@ -215,6 +507,9 @@ def main():
     result = authenticate(args.user, progress_callback=show_progress)
 
     print(f"Result: {result.value}", file=sys.stderr)
+    if args.result_fd is not None:
+        os.write(args.result_fd, f"{result.value}\n".encode())
+        os.close(args.result_fd)
 
     if result == AuthResult.MATCH:
         sys.exit(0)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Face Unlock Daemon
+Keeps the face engine loaded between authentications and serves PAM requests
+over a UNIX socket, so sudo doesn't pay for interpreter start-up and the
+cv2/dlib/face_recognition imports on every attempt.
+
+Started on demand by face-unlockd.socket (systemd socket activation).
+
+Protocol: one request per connection.
+  → {"user": "<username>"}\n
+  ← <AuthResult value>\n      e.g. "match", "no_match", "timeout"
+  ← busy\n                    another scan is running (or the caller retried too soon)
+
+Closing the connection cancels the scan.
+"""
+
+import os
+import sys
+import pwd
+import json
+import socket
+import time
+import struct
+import logging
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from face_engine import authenticate, AuthResult
+
+log = logging.getLogger("face_unlockd")
+
+SOCKET_PATH       = "/run/face-unlock.sock"
+SD_LISTEN_FDS_START = 3   # first fd passed by systemd socket activation
+REQUEST_TIMEOUT   = 2.0   # seconds a client gets to send its request line
+MAX_REQUEST_BYTES = 4096
+MAX_CLIENTS       = 8     # connections handled at once; the rest are closed unanswered
+RETRY_INTERVAL    = 2.0   # seconds a non-root caller waits between scans
+BUSY              = "busy"
+
+# There is only one camera: one scan at a time, later requests are turned away
+_scan_lock = threading.Lock()
+_clients = threading.BoundedSemaphore(MAX_CLIENTS)
+_last_scan_end = {}   # uid -> time.monotonic() the uid's last scan finished
+
+def preload():
+    """Import the recognition libraries and load the dlib models up front."""
+    try:
+        import cv2
+        import dlib
+        import face_recognition.api  # loads the predictor and ResNet weights
+        log.info(f"Models loaded (dlib {dlib.__version__}, OpenCV {cv2.__version__})")
+    except ImportError as e:
+        log.error(f"Missing dependency: {e}")
+
+def get_listen_socket() -> socket.socket:
+    """Use the socket passed by systemd, or bind one when started by hand."""
+    if os.environ.get("LISTEN_PID") == str(os.getpid()) and int(os.environ.get("LISTEN_FDS", "0")) >= 1:
+        return socket.socket(fileno=SD_LISTEN_FDS_START)
+
+    if os.path.exists(SOCKET_PATH):
+        os.unlink(SOCKET_PATH)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(SOCKET_PATH)
+    # Anyone may ask, but only for themselves (see peer_allowed)
+    os.chmod(SOCKET_PATH, 0o666)
+    sock.listen(4)
+    return sock
+
+def peer_uid(conn: socket.socket) -> int:
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    return struct.unpack("3i", creds)[1]
+
+def peer_allowed(conn: socket.socket, username: str) -> bool:
+    """Root may authenticate anyone; other callers only their own account."""
+    uid = peer_uid(conn)
+    if uid == 0:
+        return True
+    try:
+        return pwd.getpwnam(username).pw_uid == uid
+    except KeyError:
+        return False
+
+def read_request(conn: socket.socket) -> dict:
+    data = b""
+    while not data.endswith(b"\n") and len(data) < MAX_REQUEST_BYTES:
+        chunk = conn.recv(MAX_REQUEST_BYTES)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data)
+
+def client_gone(conn: socket.socket) -> bool:
+    """True once the client hung up (PAM timed out or the user chose the password)."""
+    try:
+        return conn.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+    except BlockingIOError:
+        return False
+    except OSError:
+        return True
+
+def scan(conn: socket.socket, username: str, uid: int) -> str:
+    """Run one authentication, or return BUSY if the camera is taken."""
+    if not _scan_lock.acquire(blocking=False):
+        log.info(f"Refusing face auth for '{username}': another scan is running")
+        return BUSY
+    try:
+        if uid != 0 and time.monotonic() - _last_scan_end.get(uid, float("-inf")) < RETRY_INTERVAL:
+            log.info(f"Refusing face auth for '{username}': retried too soon")
+            return BUSY
+        log.info(f"Face unlock request for user: {username}")
+        # Blocking mode, so the MSG_DONTWAIT peeks in client_gone return at once
+        conn.settimeout(None)
+        result = authenticate(username, should_abort=lambda: client_gone(conn))
+        log.info(f"Result for '{username}': {result.value}")
+        return result.value
+    finally:
+        _last_scan_end[uid] = time.monotonic()
+        _scan_lock.release()
+
+def handle(conn: socket.socket):
+    conn.settimeout(REQUEST_TIMEOUT)
+    try:
+        request = read_request(conn)
+        username = str(request["user"])
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        log.warning(f"Bad request: {e}")
+        return
+
+    if not peer_allowed(conn, username):
+        log.warning(f"Refusing face auth for '{username}': caller is not root or that user")
+        result = AuthResult.NO_MATCH.value
+    else:
+        result = scan(conn, username, peer_uid(conn))
+
+    if result == AuthResult.CANCELLED.value:
+        return  # nobody left to tell
+    try:
+        conn.sendall(result.encode() + b"\n")
+    except OSError as e:
+        log.warning(f"Client went away before the result was sent: {e}")
+
+def serve(conn: socket.socket):
+    try:
+        with conn:
+            handle(conn)
+    finally:
+        _clients.release()
+
+def main():
+    preload()
+    sock = get_listen_socket()
+    log.info(f"Listening on {SOCKET_PATH}")
+
+    # Each connection gets a short-lived thread so a slow or stuck client never
+    # holds up the accept loop; scan() lets only one of them use the camera
+    while True:
+        conn, _ = sock.accept()
+        if not _clients.acquire(blocking=False):
+            log.warning("Too many face unlock clients, dropping connection")
+            conn.close()
+            continue
+        threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,7 @@ it locks the screen.
 import os
 import sys
 import time
+import threading
 import subprocess
 import logging
 from pathlib import Path
@@ -18,6 +19,135 @@ logging.basicConfig(
 )
 log = logging.getLogger("face_guardian")
 
+# Installed side by side in /usr/local/lib/face-unlock; ../face_engine in a checkout
+sys.path[:0] = [os.path.dirname(os.path.abspath(__file__)),
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "face_engine")]
+from cpu_affinity import pin_to_cpu
+
+# Imported once for the lifetime of the service rather than on every poll
+try:
+    import cv2
+    import numpy as np
+    import face_recognition
+    HAS_FACE_RECOGNITION = True
+except ImportError as e:
+    log.error(f"Missing dependency: {e}")
+    HAS_FACE_RECOGNITION = False
+
+# OpenCV's ResNet-10 SSD face detector, installed by install.sh
+FACE_NET_MODEL  = "/usr/local/lib/face-unlock/models/opencv_face_detector_uint8.pb"
+FACE_NET_CONFIG = "/usr/local/lib/face-unlock/models/opencv_face_detector.pbtxt"
+# Lenient on purpose: this only decides whether someone is still at the desk
+FACE_NET_CONFIDENCE = 0.4
+
+_face_net = None
+_face_net_loaded = False
+
+# Skip the detector while the scene is unchanged since the last successful match
+MOTION_THRESHOLD  = 3.0    # mean absolute grey-level change on an 80x60 thumbnail
+REVERIFY_INTERVAL = 30.0   # seconds; a still scene is re-verified at least this often
+
+_motion = {"thumb": None, "verified_at": 0.0}
+
+# The camera stays open while guarding so each poll skips V4L2 init and AE warm-up
+CAMERA_MAX_FAILURES = 3    # consecutive failed reads before the device is reopened
+# Face unlock and enrollment (face_engine.request_camera) touch this while they
+# need the camera; the guardian closes the device and leaves it alone until it's gone
+CAMERA_REQUEST_PATH    = "/run/face-unlock/camera-request"
+CAMERA_REQUEST_MAX_AGE = 60.0   # seconds; older requests were left behind by a killed engine
+HANDOFF_CHECK_INTERVAL = 0.25   # seconds between request checks while waiting to poll
+
+_camera = {"cap": None, "failures": 0}
+_camera_lock = threading.Lock()
+
+_cascades = {}
+
+def get_cascade(name: str):
+    """Parse a Haar cascade XML once and reuse the classifier."""
+    if name not in _cascades:
+        _cascades[name] = cv2.CascadeClassifier(cv2.data.haarcascades + name)
+    return _cascades[name]
+
+def reset_motion_cache():
+    _motion["thumb"] = None
+    _motion["verified_at"] = 0.0
+
+def get_camera():
+    """Return the shared capture device, opening it if needed (None if busy/missing)."""
+    with _camera_lock:
+        if _camera["cap"] is None:
+            cap = cv2.VideoCapture(int(os.environ.get("FACE_UNLOCK_CAMERA", "0")))
+            if not cap.isOpened():
+                return None
+            # MJPG before the size, so 640x480 doesn't saturate USB 2.0 with raw YUYV
+            cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+            cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
+            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+            # Don't queue frames between polls; the next read should be current
+            cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+            _camera["cap"] = cap
+            _camera["failures"] = 0
+        return _camera["cap"]
+
+def release_camera():
+    """Close the shared device so face unlock (or another app) can use it."""
+    with _camera_lock:
+        if _camera["cap"] is not None:
+            _camera["cap"].release()
+            _camera["cap"] = None
+        _camera["failures"] = 0
+
+def camera_requested() -> bool:
+    """True while face unlock or enrollment is waiting for (or using) the camera."""
+    try:
+        return time.time() - os.stat(CAMERA_REQUEST_PATH).st_mtime < CAMERA_REQUEST_MAX_AGE
+    except OSError:
+        return False
+
+def wait_for_next_poll(seconds: float):
+    """
+    Sleep until the next poll, but hand the camera over as soon as face unlock
+    asks for it instead of holding it for the whole wait. The lock screen's
+    PAM prompt asks through the same request file, so no lock check is needed.
+    """
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        time.sleep(min(HANDOFF_CHECK_INTERVAL, max(0.0, deadline - time.time())))
+        if _camera["cap"] is not None and camera_requested():
+            log.info("Camera requested by face unlock, releasing it")
+            release_camera()
+
+def read_frame():
+    """Read one frame from the shared device; reopen it after repeated failures."""
+    cap = get_camera()
+    if cap is None:
+        return None
+    with _camera_lock:
+        ret, frame = cap.read()
+        if ret and frame is not None:
+            _camera["failures"] = 0
+            return frame
+        _camera["failures"] += 1
+        failures = _camera["failures"]
+    if failures >= CAMERA_MAX_FAILURES:
+        log.warning(f"Camera read failed {failures} times in a row, reopening")
+        release_camera()
+    return None
+
+def get_face_net():
+    """Load the DNN face detector once and reuse it for every poll (None if unavailable)."""
+    global _face_net, _face_net_loaded
+    if not _face_net_loaded:
+        _face_net_loaded = True
+        try:
+            net = cv2.dnn.readNetFromTensorflow(FACE_NET_MODEL, FACE_NET_CONFIG)
+            net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+            net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+            _face_net = net
+        except cv2.error as e:
+            log.warning(f"DNN face detector unavailable, using Haar cascades: {e}")
+    return _face_net
+
 def get_config(key, default):
     try:
         with open("/etc/face-unlock/config.conf") as f:
@@ -30,50 +160,68 @@ def get_config(key, default):
 
 def check_face(known_encodings, tolerance) -> dict:
     result = {"authorized": False, "present": False}
-    try:
-        import face_recognition
-        import cv2
-    except ImportError as e:
-        log.error(f"Missing dependency: {e}")
+    if not HAS_FACE_RECOGNITION:
         # Default to True to prevent accidental lockouts
         return {"authorized": True, "present": True}
 
-    # Open camera briefly
-    cap = cv2.VideoCapture(int(os.environ.get("FACE_UNLOCK_CAMERA", "0")))
-    if not cap.isOpened():
-        # Camera is likely used by another app
+    # Face unlock needs the camera: don't fight it for the device
+    if camera_requested():
+        release_camera()
         return {"authorized": True, "present": True}
 
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-    
-    # Read a few frames to let auto-exposure settle
-    ret = False
-    for _ in range(3):
-        ret, frame = cap.read()
-    
-    cap.release()
+    # Camera is likely used by another app, or the read failed
+    frame = read_frame()
+    if frame is None:
+        return {"authorized": True, "present": True}
 
-    if not ret or frame is None:
+    # If nothing moved since the authorized user was last matched, reuse that result
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    thumb = cv2.resize(gray, (80, 60), interpolation=cv2.INTER_AREA)
+    if (_motion["thumb"] is not None and
+            time.time() - _motion["verified_at"] < REVERIFY_INTERVAL and
+            cv2.absdiff(_motion["thumb"], thumb).mean() < MOTION_THRESHOLD):
+        log.debug("Scene unchanged since last match, skipping detection")
         return {"authorized": True, "present": True}
-    
-    # Check for primary authorized face using HOG
+    reset_motion_cache()
+
+    # Check for primary authorized face using HOG on a half-size frame,
+    # then scale the boxes back up so the encoder sees full-resolution faces
     rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    face_locations = face_recognition.face_locations(rgb_frame, model="hog")
+    small_frame = cv2.resize(rgb_frame, (0, 0), fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+    face_locations = [
+        (top * 2, right * 2, bottom * 2, left * 2)
+        for (top, right, bottom, left) in
+        face_recognition.face_locations(small_frame, number_of_times_to_upsample=1, model="hog")
+    ]
     
     if face_locations:
         result["present"] = True
-        face_encodings = face_recognition.face_encodings(rgb_frame, face_locations)
-        for face_encoding in face_encodings:
-            matches = face_recognition.compare_faces(known_encodings, face_encoding, tolerance=tolerance)
-            if any(matches):
-                result["authorized"] = True
-                return result
-
-    # If not authorized, check if ANY face is still present (profile or looking down)
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    frontal_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-    profile_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_profileface.xml')
+        probes = np.asarray(face_recognition.face_encodings(rgb_frame, face_locations))
+        # (faces, samples) distance matrix in one pass, then a single argmin
+        distances = np.linalg.norm(known_encodings[None, :, :] - probes[:, None, :], axis=2)
+        idx = distances.argmin()
+        min_distance = distances.flat[idx]
+        log.debug(f"Best distance {min_distance:.3f} (sample {idx % distances.shape[1]})")
+        if min_distance <= tolerance:
+            result["authorized"] = True
+            _motion["thumb"] = thumb
+            _motion["verified_at"] = time.time()
+            return result
+
+    # If not authorized, check if ANY face is still present (profile or looking down).
+    # One SSD forward pass covers frontal, profile and tilted faces.
+    net = get_face_net()
+    if net is not None:
+        blob = cv2.dnn.blobFromImage(frame, 1.0, (300, 300), [104, 117, 123])
+        net.setInput(blob)
+        detections = net.forward()  # (1, 1, N, 7); index 2 is the confidence
+        if (detections[0, 0, :, 2] > FACE_NET_CONFIDENCE).any():
+            result["present"] = True
+        return result
+
+    # Fallback when the model files are missing (e.g. running from a checkout)
+    frontal_cascade = get_cascade('haarcascade_frontalface_default.xml')
+    profile_cascade = get_cascade('haarcascade_profileface.xml')
     
     faces_front = frontal_cascade.detectMultiScale(gray, 1.3, 5)
     if len(faces_front) > 0:
@@ -93,14 +241,25 @@ def check_face(known_encodings, tolerance) -> dict:
             
     return result
 
-def load_encodings(username: str) -> list:
+def load_encodings(username: str):
     import pickle
     try:
-        path = Path(f"/etc/face-unlock/encodings/{username}.pkl")
+        # Memory-mapped: re-loading every poll is nearly free once the page cache is warm
+        path = Path(f"/etc/face-unlock/encodings/{username}.npy")
+        if path.exists():
+            return np.load(path, mmap_mode="r")
+
+        path = path.with_suffix(".pkl")  # written by older versions
         if not path.exists():
             return []
         with open(path, "rb") as f:
-            return pickle.load(f)
+            data = pickle.load(f)
+        # {"encodings": (N, 128), "centroid": ...}; older enrollments pickled
+        # just the samples. The guardian matches against every sample so
+        # partially turned faces still count as present.
+        if isinstance(data, dict):
+            data = data["encodings"]
+        return np.asarray(data, dtype=np.float16)
     except PermissionError:
         log.warning(f"Permission denied reading encodings for '{username}'. "
                      "Enable Face Guard via the toggle to fix permissions.")
@@ -154,6 +313,7 @@ def main():
         sys.exit(1)
 
     log.info("Face Guardian started.")
+    pin_to_cpu()
     last_seen_time = time.time()
     warning_process = None
 
@@ -171,13 +331,16 @@ def main():
             if warning_process:
                 warning_process.terminate()
                 warning_process = None
+            release_camera()
+            reset_motion_cache()
             time.sleep(5)
             last_seen_time = time.time()
             continue
 
         encodings = load_encodings(username)
-        if not encodings:
+        if len(encodings) == 0:
             log.info(f"No face currently enrolled for '{username}'. Guardian pausing.")
+            release_camera()
             time.sleep(10)
             continue
 
@@ -244,10 +407,12 @@ def main():
                 if warning_process:
                     warning_process.terminate()
                     warning_process = None
+                # Free the camera first so the unlock prompt can use it
+                release_camera()
                 lock_screen()
                 last_seen_time = time.time() # Reset after locking
                 
-        time.sleep(2) # Poll roughly every 2 seconds
+        wait_for_next_poll(2) # Poll roughly every 2 seconds
 
 if __name__ == "__main__":
     main()
@@ -13,8 +13,14 @@ PAM returns:
 
 import os
 import sys
+import json
+import time
+import select
+import functools
+import socket
 import subprocess
 import logging
+import logging.handlers
 
 # PAM return codes
 PAM_SUCCESS     = 0
@@ -23,24 +29,67 @@ PAM_IGNORE      = 25
 
 FACE_ENGINE_PATH = "/usr/local/lib/face-unlock/face_engine.py"
 FACE_UI_PATH     = "/usr/local/bin/face-unlock-ui"
+DAEMON_SOCKET    = "/run/face-unlock.sock"   # face-unlockd, socket-activated by systemd
+ENGINE_TIMEOUT   = 15   # seconds
+CAMERA_REQUEST_PATH = "/run/face-unlock/camera-request"   # see face_engine.request_camera
 
 log = logging.getLogger("pam_face_unlock")
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s pam_face_unlock[%(process)d]: %(message)s',
-    handlers=[logging.FileHandler("/var/log/face-unlock.log")]
+    # delay=True: the log is only opened once something is actually written
+    handlers=[logging.handlers.RotatingFileHandler("/var/log/face-unlock.log", maxBytes=1_000_000,
+                                                   backupCount=2, delay=True)]
 )
 
+CONFIG_PATH      = "/etc/face-unlock/config.conf"
+ENCODINGS_DIR    = "/etc/face-unlock/encodings"
+
+# Shared /dev/null for every child's unused stdio (Popen would open it per call)
+_DEVNULL = open(os.devnull, "r+b")
+
+# Environment for the UI, copied once per process rather than on every launch
+_BASE_ENV = os.environ.copy()
+
+# Parsed config, reused until the file's mtime changes
+_CFG_CACHE = {}
+
 def get_timeout() -> int:
     try:
-        with open("/etc/face-unlock/config.conf") as f:
-            for line in f:
-                if line.startswith("timeout"):
-                    return int(line.split("=")[1].strip())
+        mtime = os.stat(CONFIG_PATH).st_mtime_ns
+        if _CFG_CACHE.get("mtime") == mtime:
+            return _CFG_CACHE["timeout"]
+
+        timeout = 8
+        with open(CONFIG_PATH) as f:
+            lines = f.read().splitlines()
+        for line in lines:
+            key, sep, val = line.partition("=")
+            if sep and key.strip() == "timeout":
+                timeout = int(val.strip())
+                break
+        _CFG_CACHE["mtime"] = mtime
+        _CFG_CACHE["timeout"] = timeout
+        return timeout
     except Exception:
         pass
     return 8
 
+@functools.lru_cache(maxsize=32)
+def _has_encoding(username: str, dir_mtime) -> bool:
+    """
+    Whether the user is enrolled. dir_mtime only keys the cache: enrolling or
+    deleting a face adds/removes files, which bumps the directory's mtime.
+    """
+    encoding_path = f"{ENCODINGS_DIR}/{username}"
+    return os.path.exists(encoding_path + ".npy") or os.path.exists(encoding_path + ".pkl")
+
+def is_enrolled(username: str) -> bool:
+    try:
+        return _has_encoding(username, os.stat(ENCODINGS_DIR).st_mtime_ns)
+    except OSError:
+        return False
+
 def pam_sm_authenticate(pamh, flags, argv):
     """Called by PAM to authenticate a user."""
     try:
@@ -51,12 +100,11 @@ def pam_sm_authenticate(pamh, flags, argv):
             log.warning("Could not determine PAM user")
             return PAM_AUTH_ERR
 
-        log.info(f"Face unlock attempt for user: {username}")
+        log.info("Face unlock attempt for user: %s", username)
 
         # Check if face data is enrolled
-        encoding_path = f"/etc/face-unlock/encodings/{username}.pkl"
-        if not os.path.exists(encoding_path):
-            log.info(f"No face enrolled for '{username}', skipping face auth")
+        if not is_enrolled(username):
+            log.info("No face enrolled for '%s', skipping face auth", username)
             return PAM_IGNORE
 
         # Launch UI process + face engine together
@@ -65,73 +113,225 @@ def pam_sm_authenticate(pamh, flags, argv):
         timeout_val = get_timeout()
         try:
             # Launch the UI wrapper script (handles getting user's display env)
-            env = os.environ.copy()
-            env["SUDO_USER"] = username
+            env = {**_BASE_ENV, "SUDO_USER": username}
             ui_proc = subprocess.Popen(
-                [FACE_UI_PATH, "--mode", "scanning", "--timeout", str(timeout_val)],
+                [FACE_UI_PATH, "--mode", "scanning", "--timeout", str(timeout_val), "--control-fd", "0"],
                 env=env,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL
+                stdin=subprocess.PIPE,    # we write "success"/"failed" here when done
+                stdout=subprocess.PIPE,   # prints "cancel" on "Use Password Instead"
+                stderr=_DEVNULL,
+                close_fds=True
             )
         except Exception as e:
-            log.warning(f"Could not launch UI: {e}")
+            log.warning("Could not launch UI: %s", e)
 
         # Run face recognition
-        result = run_face_engine(username)
+        result = run_face_engine(username, ui_proc.stdout.fileno() if ui_proc else None)
 
-        if result == "match":
-            log.info(f"Face authentication SUCCEEDED for '{username}'")
-            # Signal UI: success
+        if result == "cancelled":
+            log.info("Face authentication cancelled by '%s', using password", username)
             if ui_proc:
                 ui_proc.terminate()
-                launch_ui_state("success", username)
+            return PAM_AUTH_ERR
+        elif result == "match":
+            log.info("Face authentication SUCCEEDED for '%s'", username)
+            # Signal UI: success
+            if ui_proc:
+                signal_ui(ui_proc, "success", username)
             return PAM_SUCCESS
         else:
-            log.info(f"Face authentication FAILED for '{username}' (result={result})")
+            log.info("Face authentication FAILED for '%s' (result=%s)", username, result)
             # Signal UI: failed → show password fallback
             if ui_proc:
-                ui_proc.terminate()
-                launch_ui_state("failed", username)
+                signal_ui(ui_proc, "failed", username)
             return PAM_AUTH_ERR
 
     except Exception as e:
-        log.error(f"Unexpected error in PAM module: {e}")
+        log.error("Unexpected error in PAM module: %s", e)
         return PAM_AUTH_ERR
 
-def run_face_engine(username: str) -> str:
+def run_face_engine(username: str, cancel_fd=None) -> str:
+    """
+    Asks the face-unlockd daemon to authenticate, falling back to running the
+    face engine as a subprocess when the daemon isn't installed or running.
+    cancel_fd is the UI's stdout; a "cancel" line on it aborts the scan.
+    Returns: 'match', 'no_match', 'timeout', 'camera_error', 'cancelled', etc.
+    """
+    result = query_daemon(username, cancel_fd)
+    if result is not None:
+        return result
+    return spawn_face_engine(username, cancel_fd)
+
+def read_cancel(fd: int, pending: bytearray):
     """
-    Runs the face engine as a subprocess.
-    Returns: 'match', 'no_match', 'timeout', 'camera_error', etc.
+    Reads what the UI printed. Returns True once it asked to cancel, False if
+    not (yet), and None at EOF (the UI exited; keep scanning without it).
     """
+    chunk = os.read(fd, 4096)
+    if not chunk:
+        return None
+    pending += chunk
+    *lines, rest = pending.split(b"\n")
+    pending[:] = rest
+    return any(line.strip() == b"cancel" for line in lines)
+
+def query_daemon(username: str, cancel_fd=None):
+    """Returns the daemon's result, or None if it can't be reached."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(ENGINE_TIMEOUT)
     try:
-        proc = subprocess.run(
-            [sys.executable, FACE_ENGINE_PATH, "--user", username],
-            capture_output=True,
-            timeout=15,
-            text=True
-        )
-        # Parse result from stdout
-        for line in proc.stderr.splitlines():
-            if line.startswith("Result:"):
-                return line.split(":", 1)[1].strip()
-        return "no_match" if proc.returncode != 0 else "match"
-    except subprocess.TimeoutExpired:
+        try:
+            sock.connect(DAEMON_SOCKET)
+        except OSError as e:
+            log.info("Face daemon unavailable (%s), starting engine directly", e)
+            return None
+        sock.sendall(json.dumps({"user": username}).encode() + b"\n")
+
+        poller = select.poll()
+        poller.register(sock.fileno(), select.POLLIN)
+        if cancel_fd is not None:
+            poller.register(cancel_fd, select.POLLIN)
+        reply, pending = b"", bytearray()
+        deadline = time.monotonic() + ENGINE_TIMEOUT
+        while not reply.endswith(b"\n"):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return "timeout"
+            for fd, _ in poller.poll(remaining * 1000):
+                if fd == cancel_fd:
+                    cancelled = read_cancel(fd, pending)
+                    if cancelled:
+                        return "cancelled"
+                    if cancelled is None:
+                        poller.unregister(fd)
+                    continue
+                chunk = sock.recv(64)
+                if not chunk:
+                    return reply.decode().strip() or "camera_error"
+                reply += chunk
+        return reply.decode().strip()
+    except socket.timeout:
         return "timeout"
     except Exception as e:
-        log.error(f"Face engine error: {e}")
+        log.error("Face daemon error: %s", e)
         return "camera_error"
+    finally:
+        sock.close()
+
+def wait_engine(proc, result_fd, cancel_fd, timeout):
+    """
+    Event-driven wait on the engine subprocess: wakes as soon as it exits
+    (pidfd), when it writes its result or when the UI asks to cancel.
+    Returns (status, result bytes) where status is 'exited', 'cancelled' or
+    'timeout'. Raises AttributeError/OSError where pidfd_open isn't available.
+    """
+    pidfd = os.pidfd_open(proc.pid)
+    try:
+        poller = select.poll()
+        poller.register(pidfd, select.POLLIN)
+        poller.register(result_fd, select.POLLIN)
+        if cancel_fd is not None:
+            poller.register(cancel_fd, select.POLLIN)
+
+        output, pending = [], bytearray()
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return "timeout", b"".join(output)
+            for fd, _ in poller.poll(remaining * 1000):
+                if fd == pidfd:
+                    proc.wait()
+                    output.append(os.read(result_fd, 64))
+                    return "exited", b"".join(output)
+                if fd == cancel_fd:
+                    cancelled = read_cancel(fd, pending)
+                    if cancelled:
+                        return "cancelled", b"".join(output)
+                    if cancelled is None:
+                        poller.unregister(fd)
+                    continue
+                chunk = os.read(fd, 64)
+                if chunk:
+                    output.append(chunk)
+                else:
+                    poller.unregister(fd)
+    finally:
+        os.close(pidfd)
+
+def spawn_face_engine(username: str, cancel_fd=None) -> str:
+    """
+    Runs the face engine as a one-off subprocess. The engine writes only its
+    result to a dedicated pipe, so its log output never has to be read.
+    """
+    result_r, result_w = os.pipe()
+    try:
+        try:
+            proc = subprocess.Popen(
+                [sys.executable, FACE_ENGINE_PATH, "--user", username, "--result-fd", str(result_w)],
+                pass_fds=(result_w,),
+                stdout=_DEVNULL,
+                stderr=_DEVNULL
+            )
+        finally:
+            os.close(result_w)
+        try:
+            status, output = wait_engine(proc, result_r, cancel_fd, ENGINE_TIMEOUT)
+        except (AttributeError, OSError):
+            # No pidfd_open (Python < 3.9 or kernel < 5.3): plain timed wait
+            try:
+                proc.wait(timeout=ENGINE_TIMEOUT)
+                status, output = "exited", os.read(result_r, 64)
+            except subprocess.TimeoutExpired:
+                status, output = "timeout", b""
+
+        if status != "exited":
+            # SIGTERM first: the engine exits through its finally blocks, which
+            # release the camera and remove the guardian hand-off request
+            proc.terminate()
+            try:
+                proc.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+                try:
+                    os.unlink(CAMERA_REQUEST_PATH)
+                except OSError:
+                    pass
+            return status
+
+        result = output.decode(errors="replace").strip()
+        if result:
+            return result
+        return "no_match" if proc.returncode != 0 else "match"
+    except Exception as e:
+        log.error("Face engine error: %s", e)
+        return "camera_error"
+    finally:
+        os.close(result_r)
+
+def signal_ui(ui_proc, state: str, username: str = ""):
+    """Switch the running scanning UI to success/failed; it closes itself afterwards."""
+    if ui_proc.poll() is None:
+        try:
+            ui_proc.stdin.write(f"{state}\n".encode())
+            ui_proc.stdin.close()
+            return
+        except OSError:
+            ui_proc.terminate()
+    # The scanning UI is gone (crashed or never got a display): start a fresh one
+    launch_ui_state(state, username)
 
 def launch_ui_state(state: str, username: str = ""):
     """Launch UI briefly to show success/failure state."""
     try:
-        env = os.environ.copy()
-        if username:
-            env["SUDO_USER"] = username
+        env = {**_BASE_ENV, "SUDO_USER": username} if username else _BASE_ENV
         subprocess.Popen(
             [FACE_UI_PATH, "--mode", state],
             env=env,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
+            stdout=_DEVNULL,
+            stderr=_DEVNULL,
+            close_fds=True
         )
     except Exception:
         pass
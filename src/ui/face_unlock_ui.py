@@ -17,6 +17,7 @@ import math
 import argparse
 import threading
 import logging
+import cairo
 
 # Setup Logging
 logging.basicConfig(
@@ -163,6 +164,18 @@ window {
 }
 """
 
+# ─── Animation Tables ─────────────────────────────────────────────────────────
+# The animations only sample sin() at integer ticks, so one period is tabulated
+
+FRAME_INTERVAL_US = 1_000_000 / 60   # the animation constants below assume 60 Hz
+MAX_FRAME_STEP    = 10.0             # cap the catch-up after a long stall
+
+_DEG2RAD = math.pi / 180.0
+_TWO_PI  = 2 * math.pi
+_SCAN_PULSE_LUT = [0.5 + 0.5 * math.sin(i * 0.08) for i in range(round(2 * math.pi / 0.08))]  # 79
+_WARN_PULSE_LUT = [0.5 + 0.5 * math.sin(i * 0.1) for i in range(round(2 * math.pi / 0.1))]    # 63
+_SHAKE_LUT = [8 * math.sin(t * 0.6) * (1 - t / 40) for t in range(41)]
+
 # ─── Drawing Area (Custom Face Ring) ──────────────────────────────────────────
 
 class FaceRingWidget(Gtk.DrawingArea):
@@ -182,38 +195,84 @@ class FaceRingWidget(Gtk.DrawingArea):
         self.pulse = 0.0          # pulsing glow amount
         self.fill_progress = 0.0  # fill level on success
         self.shake_offset = 0.0   # x offset on failure
-        self._tick = 0
+        self._tick = 0.0          # animation time, in 60 Hz frames
+        self._state_tick = 0.0    # frames since the current state began
+        self._timer_id = None     # tick callback id while animating
+        self._last_frame_time = None
+        self._static_surface = None  # background circle + silhouette, drawn once per size
+        self._static_size = None
+        self._drawers = {
+            "scanning": self._draw_scanning_ring,
+            "success":  self._draw_success_ring,
+            "failed":   self._draw_failed_ring,
+            "warning":  self._draw_warning_ring,
+            "idle":     self._draw_idle_ring,
+        }
 
         if HAS_GTK4:
             self.set_draw_func(self._draw_gtk4)
         else:
             self.connect("draw", self._draw_gtk3)
 
-        # Animation timer — 60fps
-        GLib.timeout_add(16, self._animate)
+        # Animation driven by the frame clock, stopped while nothing moves
+        self._start_animation()
 
     def set_state(self, state: str):
         self.state = state
+        self._state_tick = 0.0
         if state == "success":
             self.fill_progress = 0.0
         elif state == "failed":
             self.shake_offset = 0.0
+        self._start_animation()
+
+    def _start_animation(self):
+        if self._timer_id is None:
+            self._last_frame_time = None
+            self._timer_id = self.add_tick_callback(self._on_tick)
+
+    def _on_tick(self, widget, frame_clock):
+        # Fires once per displayed frame and not at all while unmapped. Advance
+        # by the elapsed time so speed is the same at any refresh rate or when
+        # frames are dropped.
+        now = frame_clock.get_frame_time()  # microseconds
+        if self._last_frame_time is None:
+            frames = 1.0
+        else:
+            frames = min((now - self._last_frame_time) / FRAME_INTERVAL_US, MAX_FRAME_STEP)
+        self._last_frame_time = now
+        return GLib.SOURCE_CONTINUE if self._animate(frames) else GLib.SOURCE_REMOVE
+
+    def _is_static(self) -> bool:
+        """True once the current state's last frame has been drawn."""
+        if self.state == "idle":
+            return True
+        if self.state == "success":
+            return self.fill_progress >= 1.0
+        if self.state == "failed":
+            return self._state_tick >= 40  # the shake plays once
+        return False
 
-    def _animate(self):
-        self._tick += 1
+    def _animate(self, frames: float = 1.0):
+        self._tick += frames
+        self._state_tick += frames
+        tick = int(self._tick)
         if self.state == "scanning":
-            self.angle = (self.angle + 3.5) % 360
-            self.pulse = 0.5 + 0.5 * math.sin(self._tick * 0.08)
+            self.angle = (self.angle + 3.5 * frames) % 360
+            self.pulse = _SCAN_PULSE_LUT[tick % len(_SCAN_PULSE_LUT)]
         elif self.state == "success":
-            self.fill_progress = min(1.0, self.fill_progress + 0.04)
+            self.fill_progress = min(1.0, self.fill_progress + 0.04 * frames)
         elif self.state == "failed":
-            t = self._tick % 40
-            self.shake_offset = 8 * math.sin(t * 0.6) * max(0, 1 - t / 40)
+            self.shake_offset = _SHAKE_LUT[min(int(self._state_tick), 40)]
         elif self.state == "warning":
-            self.pulse = 0.5 + 0.5 * math.sin(self._tick * 0.1)
+            self.pulse = _WARN_PULSE_LUT[tick % len(_WARN_PULSE_LUT)]
 
         self.queue_draw()
-        return True  # keep timer running
+        if self._is_static():
+            # Nothing changes until the next set_state(), which restarts us
+            self._timer_id = None
+            return False
+        return True
 
     def _draw_gtk4(self, widget, cr, width, height):
         self._paint(cr, width, height)
@@ -223,69 +282,78 @@ class FaceRingWidget(Gtk.DrawingArea):
         h = widget.get_allocated_height()
         self._paint(cr, w, h)
 
+    def _get_static_surface(self, cr, width, height):
+        """The parts that never change, rendered once and reused every frame."""
+        if self._static_surface is None or self._static_size != (width, height):
+            surface = cr.get_target().create_similar(cairo.CONTENT_COLOR_ALPHA, width, height)
+            sc = cairo.Context(surface)
+            cx = width / 2
+            cy = height / 2
+            r = (min(width, height) / 2) - 14
+
+            # ── Background circle ──────────────────────────────────────────
+            sc.set_source_rgba(1, 1, 1, 0.06)
+            sc.arc(cx, cy, r, 0, 2 * math.pi)
+            sc.fill()
+
+            # ── Face icon (person silhouette) ──────────────────────────────
+            # Head
+            sc.set_source_rgba(1, 1, 1, 0.3)
+            sc.arc(cx, cy - 22, 28, 0, 2 * math.pi)
+            sc.fill()
+            # Shoulders
+            sc.arc(cx, cy + 40, 44, math.pi, 2 * math.pi)
+            sc.fill()
+
+            self._static_surface = surface
+            self._static_size = (width, height)
+        return self._static_surface
+
     def _paint(self, cr, width, height):
         cx = width / 2 + self.shake_offset
         cy = height / 2
         r = (min(width, height) / 2) - 14
 
-        # ── Background circle ──────────────────────────────────────────────
-        cr.set_source_rgba(1, 1, 1, 0.06)
-        cr.arc(cx, cy, r, 0, 2 * math.pi)
-        cr.fill()
-
-        # ── Face icon (person silhouette) ──────────────────────────────────
-        # Head
-        cr.set_source_rgba(1, 1, 1, 0.3)
-        cr.arc(cx, cy - 22, 28, 0, 2 * math.pi)
-        cr.fill()
-        # Shoulders
-        cr.arc(cx, cy + 40, 44, math.pi, 2 * math.pi)
-        cr.fill()
+        # Blit at the shake offset so the silhouette moves with the ring
+        cr.set_source_surface(self._get_static_surface(cr, width, height), self.shake_offset, 0)
+        cr.paint()
 
         # ── State rendering ────────────────────────────────────────────────
-        if self.state == "scanning":
-            self._draw_scanning_ring(cr, cx, cy, r)
-        elif self.state == "success":
-            self._draw_success_ring(cr, cx, cy, r)
-        elif self.state == "failed":
-            self._draw_failed_ring(cr, cx, cy, r)
-        elif self.state == "warning":
-            self._draw_warning_ring(cr, cx, cy, r)
-        elif self.state == "idle":
-            self._draw_idle_ring(cr, cx, cy, r)
+        drawer = self._drawers.get(self.state)
+        if drawer:
+            drawer(cr, cx, cy, r)
 
     def _draw_scanning_ring(self, cr, cx, cy, r):
-        import math
+        start = (self.angle - 30) * _DEG2RAD
+        end   = (self.angle + 250) * _DEG2RAD
 
-        start = math.radians(self.angle - 30)
-        end   = math.radians(self.angle + 250)
+        # Glow and main arc share one path: build it once, stroke it twice
+        cr.arc(cx, cy, r, start, end)
 
         # Glow effect
         glow_alpha = 0.12 + 0.08 * self.pulse
         cr.set_source_rgba(1.0, 0.85, 0.0, glow_alpha)
         cr.set_line_width(self.RING_THICKNESS * 3.5)
-        cr.arc(cx, cy, r, start, end)
-        cr.stroke()
+        cr.stroke_preserve()
 
         # Main arc — golden yellow (Face ID color)
         cr.set_source_rgba(1.0, 0.85, 0.0, 0.95)
         cr.set_line_width(self.RING_THICKNESS)
-        cr.arc(cx, cy, r, start, end)
         cr.stroke()
 
         # Trailing fade — light arc behind
         cr.set_source_rgba(1.0, 0.85, 0.0, 0.25)
         cr.set_line_width(self.RING_THICKNESS * 0.5)
-        cr.arc(cx, cy, r, end, end + math.radians(60))
+        cr.arc(cx, cy, r, end, end + 60 * _DEG2RAD)
         cr.stroke()
 
     def _draw_success_ring(self, cr, cx, cy, r):
-        end_angle = 2 * math.pi * self.fill_progress
+        end_angle = _TWO_PI * self.fill_progress
 
         # Background ring
         cr.set_source_rgba(0.2, 0.78, 0.35, 0.15)
         cr.set_line_width(self.RING_THICKNESS)
-        cr.arc(cx, cy, r, 0, 2 * math.pi)
+        cr.arc(cx, cy, r, 0, _TWO_PI)
         cr.stroke()
 
         # Green fill ring
@@ -306,15 +374,14 @@ class FaceRingWidget(Gtk.DrawingArea):
             cr.stroke()
 
     def _draw_failed_ring(self, cr, cx, cy, r):
-        # Red full ring
+        # Red full ring (wide faint stroke, then the solid one on the same path)
+        cr.arc(cx + self.shake_offset, cy, r, 0, _TWO_PI)
         cr.set_source_rgba(1.0, 0.23, 0.19, 0.2)
         cr.set_line_width(self.RING_THICKNESS * 2)
-        cr.arc(cx + self.shake_offset, cy, r, 0, 2 * math.pi)
-        cr.stroke()
+        cr.stroke_preserve()
 
         cr.set_source_rgba(1.0, 0.23, 0.19, 0.9)
         cr.set_line_width(self.RING_THICKNESS)
-        cr.arc(cx + self.shake_offset, cy, r, 0, 2 * math.pi)
         cr.stroke()
 
         # X mark
@@ -327,33 +394,52 @@ class FaceRingWidget(Gtk.DrawingArea):
         cr.move_to(cx2 + s, cy - s); cr.line_to(cx2 - s, cy + s); cr.stroke()
 
     def _draw_warning_ring(self, cr, cx, cy, r):
+        cr.arc(cx, cy, r, 0, _TWO_PI)
+
         # Pulsing orange glow
         glow_alpha = 0.2 + 0.15 * self.pulse
         cr.set_source_rgba(1.0, 0.58, 0.0, glow_alpha)
         cr.set_line_width(self.RING_THICKNESS * 4)
-        cr.arc(cx, cy, r, 0, 2 * math.pi)
-        cr.stroke()
+        cr.stroke_preserve()
 
         # Solid orange ring
         cr.set_source_rgba(1.0, 0.58, 0.0, 0.95)
         cr.set_line_width(self.RING_THICKNESS)
-        cr.arc(cx, cy, r, 0, 2 * math.pi)
         cr.stroke()
 
     def _draw_idle_ring(self, cr, cx, cy, r):
         cr.set_source_rgba(1, 1, 1, 0.2)
         cr.set_line_width(self.RING_THICKNESS)
-        cr.arc(cx, cy, r, 0, 2 * math.pi)
+        cr.arc(cx, cy, r, 0, _TWO_PI)
         cr.stroke()
 
 # ─── Main Window ───────────────────────────────────────────────────────────────
 
 class FaceUnlockWindow:
-    def __init__(self, initial_mode="scanning", on_password=None, timeout=0):
+    _css_provider = None   # installed once per process, see _apply_css
+    _display = None        # Gdk.Display (GTK4) or Gdk.Screen (GTK3)
+
+    _STATUS = {
+        "scanning": "Face ID",
+        "success":  "Unlocked",
+        "failed":   "Not Recognized",
+        "warning":  "Warning",
+        "idle":     "Face Unlock",
+    }
+    # Scanning and warning subtitles include the countdown, see _get_subtitle_text
+    _SUBTITLE = {
+        "success":  "Welcome back!",
+        "failed":   "Face not recognized — use password",
+        "idle":     "",
+    }
+
+    def __init__(self, initial_mode="scanning", on_password=None, timeout=0, control_fd=None):
         self.mode = initial_mode
         self.on_password = on_password
         self.password_shown = False
         self.timeout_remaining = timeout
+        self.control_fd = control_fd
+        self._control_buf = b""
 
         if HAS_GTK4:
             self.app = Adw.Application(
@@ -365,26 +451,34 @@ class FaceUnlockWindow:
             self._build_ui_gtk3()
 
     def _apply_css(self):
+        # The provider and display are shared by every window in the process,
+        # so the stylesheet is parsed and installed once
+        cls = FaceUnlockWindow
+        if cls._css_provider is not None:
+            return
         provider = Gtk.CssProvider()
         if HAS_GTK4:
             provider.load_from_data(GTK_CSS)
-            display = Gdk.Display.get_default()
-            if display:
+            cls._display = Gdk.Display.get_default()
+            if cls._display:
                 Gtk.StyleContext.add_provider_for_display(
-                    display,
+                    cls._display,
                     provider,
                     Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION
                 )
+                cls._css_provider = provider
             else:
-                print("Warning: Gdk.Display.get_default() returned None")
+                logger.warning("Gdk.Display.get_default() returned None")
         else:
             try:
                 provider.load_from_data(GTK_CSS)
+                cls._display = Gdk.Screen.get_default()
                 Gtk.StyleContext.add_provider_for_screen(
-                    Gdk.Screen.get_default(),
+                    cls._display,
                     provider,
                     Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION
                 )
+                cls._css_provider = provider
             except Exception as e:
                 logger.error(f"CSS loading error: {e}")
 
@@ -484,7 +578,7 @@ class FaceUnlockWindow:
             self.fallback_btn.add_css_class("fallback-button")
         else:
             self.fallback_btn.get_style_context().add_class("fallback-button")
-        self.fallback_btn.connect("clicked", self._show_password_fallback)
+        self.fallback_btn.connect("clicked", self._on_fallback_clicked)
         self._add_widget(outer, self.fallback_btn, 0, 0, 0, 24)
 
         # Initially hide password box, show fallback button only when scanning
@@ -492,6 +586,11 @@ class FaceUnlockWindow:
 
         self._add_widget_fill(outer, Gtk.Box(), 20)
 
+        # State changes from the PAM module, once the widgets exist
+        if self.control_fd is not None:
+            GLib.io_add_watch(self.control_fd, GLib.PRIORITY_DEFAULT,
+                              GLib.IO_IN | GLib.IO_HUP, self._on_control)
+
         if HAS_GTK4:
             self.win.set_child(outer)
             self.win.present()
@@ -522,13 +621,7 @@ class FaceUnlockWindow:
             parent.pack_start(widget, True, True, margin)
 
     def _get_status_text(self):
-        return {
-            "scanning": "Face ID",
-            "success":  "Unlocked",
-            "failed":   "Not Recognized",
-            "warning":  "Warning",
-            "idle":     "Face Unlock",
-        }.get(self.mode, "Face Unlock")
+        return self._STATUS.get(self.mode, "Face Unlock")
 
     def _get_subtitle_text(self):
         if self.mode == "scanning":
@@ -539,11 +632,7 @@ class FaceUnlockWindow:
             if getattr(self, "timeout_remaining", 0) > 0:
                 return f"Authorized face not detected ({self.timeout_remaining}s)\nLocking screen"
             return "Authorized face not detected"
-        return {
-            "success":  "Welcome back!",
-            "failed":   "Face not recognized — use password",
-            "idle":     "",
-        }.get(self.mode, "")
+        return self._SUBTITLE.get(self.mode, "")
 
     def set_mode(self, mode: str):
         self.mode = mode
@@ -562,6 +651,21 @@ class FaceUnlockWindow:
 
         self.fallback_btn.set_visible(mode == "scanning")
 
+    def _on_control(self, fd, condition):
+        """Reads newline-separated states ("success", "failed") from the control fd."""
+        data = os.read(fd, 1024)
+        if not data:
+            return False
+        *lines, self._control_buf = (self._control_buf + data).split(b"\n")
+        for line in lines:
+            state = line.decode(errors="replace").strip()
+            if state in ("success", "failed"):
+                self.set_mode(state)
+                if state == "failed":
+                    # Leave the failure on screen briefly; the password prompt is in the terminal
+                    GLib.timeout_add(3000, self._close)
+        return True
+
     def _countdown_tick(self, *_):
         if self.mode in ["scanning", "warning"]:
             self.timeout_remaining -= 1
@@ -570,6 +674,11 @@ class FaceUnlockWindow:
                 return True
         return False
 
+    def _on_fallback_clicked(self, *_):
+        # Tell the PAM module (reading our stdout) to stop the face scan
+        print("cancel", flush=True)
+        self._show_password_fallback()
+
     def _show_password_fallback(self, *_):
         if not self.password_shown:
             self.password_shown = True
@@ -634,6 +743,8 @@ def main():
                         help="Optional timeout in seconds for scanning countdown")
     parser.add_argument("--demo", action="store_true",
                         help="Demo mode: cycle through all states")
+    parser.add_argument("--control-fd", type=int, default=None,
+                        help="Read state changes (success/failed) from this fd")
     args = parser.parse_args()
 
     if not HAS_GTK4 and not HAS_GTK3:
@@ -641,7 +752,7 @@ def main():
         sys.exit(1)
 
     logger.debug(f"Creating FaceUnlockWindow with mode={args.mode}")
-    app = FaceUnlockWindow(initial_mode=args.mode, timeout=args.timeout)
+    app = FaceUnlockWindow(initial_mode=args.mode, timeout=args.timeout, control_fd=args.control_fd)
 
     if args.demo:
         logger.info("Demo mode enabled.")
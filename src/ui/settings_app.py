@@ -1,23 +1,44 @@
 #!/usr/bin/env python3
 import sys
 import os
-import subprocess
+import re
+import queue
+import atexit
 import getpass
-import threading
 import logging
+import logging.handlers
 from pathlib import Path
 
-# Configure logging to stdout and a file for easy monitoring
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s [%(levelname)s] %(name)s: %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler("/tmp/face-unlock-settings.log")
-    ]
-)
+# Configure logging to stdout and a file for easy monitoring. Log calls on the
+# GTK main loop only enqueue the record; a listener thread does the writes.
+_log_formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(name)s: %(message)s')
+_log_handlers = [
+    logging.StreamHandler(sys.stdout),
+    logging.FileHandler("/tmp/face-unlock-settings.log")
+]
+for _handler in _log_handlers:
+    _handler.setFormatter(_log_formatter)
+_log_queue = queue.Queue(-1)
+logging.getLogger().addHandler(logging.handlers.QueueHandler(_log_queue))
+logging.getLogger().setLevel(logging.DEBUG)
+_log_listener = logging.handlers.QueueListener(_log_queue, *_log_handlers)
+_log_listener.start()
+atexit.register(_log_listener.stop)  # flushes whatever is still queued
 log = logging.getLogger("settings_app")
 
+# key = value, one per line; whole-line and trailing # comments are ignored
+_KV_RE = re.compile(rb"^[ \t]*([A-Za-z_]\w*)[ \t]*=[ \t]*([^\r\n#]*?)[ \t\r]*(?:#[^\n]*)?$", re.MULTILINE)
+
+# The only variables pkexec, polkit and the launched GUI need; the rest of the
+# session environment is not passed along (pkexec would drop most of it anyway)
+PKEXEC_ENV_KEYS = ("PATH", "HOME", "USER", "LANG", "DBUS_SESSION_BUS_ADDRESS",
+                   "WAYLAND_DISPLAY", "XDG_SESSION_TYPE", "XAUTHORITY")
+
+# Keys written by Apply; one regex pass finds and rewrites all of them in place
+_CFG_KEYS = ("guard_enabled", "guard_lock_delay", "guard_warning_delay", "threshold", "timeout")
+_CFG_RE = re.compile(rb"^([ \t]*)(" + b"|".join(k.encode() for k in _CFG_KEYS) + rb")[ \t]*=.*$",
+                     re.MULTILINE)
+
 try:
     import gi
     gi.require_version('Gtk', '4.0')
@@ -33,8 +54,15 @@ class FaceUnlockSettings(Adw.Application):
                          flags=Gio.ApplicationFlags.NON_UNIQUE)
         
         self.username = os.environ.get("SUDO_USER", os.environ.get("USER", getpass.getuser()))
-        self.encoding_path = Path(f"/etc/face-unlock/encodings/{self.username}.pkl")
+        # .pkl is the format written by older versions
+        self.encoding_paths = [Path(f"/etc/face-unlock/encodings/{self.username}{ext}")
+                               for ext in (".npy", ".pkl")]
         self.config_path = Path("/etc/face-unlock/config.conf")
+        # Reused by every Apply instead of resolving the path each click
+        self.config_file = Gio.File.new_for_path(str(self.config_path))
+        # Parsed config and the (st_mtime_ns, st_size) it was parsed at
+        self._cfg_cache = None
+        self._cfg_mtime = None
 
     def read_config(self):
         """Parse config.conf into a dict."""
@@ -45,17 +73,21 @@ class FaceUnlockSettings(Adw.Application):
             "threshold": "0.55",
             "timeout": "20",
         }
-        if self.config_path.exists():
-            try:
-                with open(self.config_path, "r") as f:
-                    for line in f:
-                        line = line.strip()
-                        if "=" in line and not line.startswith("#"):
-                            k, v = line.split("=", 1)
-                            defaults[k.strip()] = v.strip()
-            except Exception:
-                pass
-        return defaults
+        try:
+            st = self.config_path.stat()
+        except OSError:
+            return defaults
+        if self._cfg_cache is not None and self._cfg_mtime == (st.st_mtime_ns, st.st_size):
+            return dict(self._cfg_cache)
+        try:
+            data = self.config_path.read_bytes()
+        except OSError:
+            return defaults
+        for m in _KV_RE.finditer(data):
+            defaults[m.group(1).decode()] = m.group(2).decode(errors="replace")
+        self._cfg_cache = defaults
+        self._cfg_mtime = (st.st_mtime_ns, st.st_size)
+        return dict(defaults)
 
     def do_activate(self):
         self.win = Adw.ApplicationWindow(application=self, title="Lock Face")
@@ -212,7 +244,7 @@ class FaceUnlockSettings(Adw.Application):
     def refresh_state(self):
         # Check if enrolled (may fail if encodings dir is root-only)
         try:
-            is_enrolled = self.encoding_path.exists()
+            is_enrolled = any(p.exists() for p in self.encoding_paths)
         except PermissionError:
             is_enrolled = False
         
@@ -262,12 +294,12 @@ class FaceUnlockSettings(Adw.Application):
     def on_enroll_clicked(self, btn):
         log.info("Enroll Face button clicked.")
         self.enroll_btn.set_sensitive(False)
-        def task():
-            log.info("Starting enrollment process...")
-            self.run_pkexec_command(["/usr/bin/python3", "/usr/local/lib/face-unlock/enroll.py"])
+        log.info("Starting enrollment process...")
+
+        def on_done(ok):
             log.info("Enrollment process finished. Refreshing state.")
-            GLib.idle_add(self.refresh_state)
-        threading.Thread(target=task, daemon=True).start()
+            self.refresh_state()
+        self.run_pkexec_command(["/usr/bin/python3", "/usr/local/lib/face-unlock/enroll.py"], on_done)
 
     def on_delete_clicked(self, btn):
         dialog = Adw.MessageDialog(heading="Delete face data?",
@@ -281,12 +313,13 @@ class FaceUnlockSettings(Adw.Application):
             log.info(f"Delete face data dialog response: {response}")
             if response == "delete":
                 self.delete_btn.set_sensitive(False)
-                def task():
-                    log.info("Starting face data deletion...")
-                    self.run_pkexec_command(["/usr/bin/python3", "/usr/local/lib/face-unlock/enroll.py", "--delete"])
+                log.info("Starting face data deletion...")
+
+                def on_done(ok):
                     log.info("Deletion process finished. Refreshing state.")
-                    GLib.idle_add(self.refresh_state)
-                threading.Thread(target=task, daemon=True).start()
+                    self.refresh_state()
+                self.run_pkexec_command(["/usr/bin/python3", "/usr/local/lib/face-unlock/enroll.py", "--delete"],
+                                        on_done)
                 
         dialog.connect("response", on_response)
         dialog.present()
@@ -307,104 +340,144 @@ class FaceUnlockSettings(Adw.Application):
                  f"guard_warning_delay={warning_delay}, "
                  f"threshold={threshold}, timeout={timeout}")
         
-        def task():
-            # 1. Read existing config, update all keys, write back
+        # 1. Read existing config, update all keys, write back. Both steps are
+        #    async Gio file operations, so the main loop never waits on the disk.
+        #    The write goes to a temp file renamed over the config where the
+        #    directory allows it; /etc/face-unlock is root-owned, so GLib
+        #    falls back to rewriting the (world-writable) file in place.
+        updates = {
+            "guard_enabled": guard_value,
+            "guard_lock_delay": lock_delay,
+            "guard_warning_delay": warning_delay,
+            "threshold": threshold,
+            "timeout": timeout,
+        }
+        def on_loaded(file, res):
             try:
-                updates = {
-                    "guard_enabled": guard_value,
-                    "guard_lock_delay": lock_delay,
-                    "guard_warning_delay": warning_delay,
-                    "threshold": threshold,
-                    "timeout": timeout,
-                }
-                
-                lines = []
-                if self.config_path.exists():
-                    with open(self.config_path, "r") as f:
-                        lines = f.readlines()
-                
-                keys_written = set()
-                with open(self.config_path, "w") as f:
-                    for line in lines:
-                        stripped = line.strip()
-                        if stripped.startswith("#") or "=" not in stripped:
-                            f.write(line)
-                            continue
-                        key = stripped.split("=", 1)[0].strip()
-                        if key in updates:
-                            f.write(f"{key} = {updates[key]}\n")
-                            keys_written.add(key)
-                        else:
-                            f.write(line)
-                    # Write any new keys that weren't in the file
-                    for key, val in updates.items():
-                        if key not in keys_written:
-                            f.write(f"{key} = {val}\n")
-                
-                log.info("Config file updated successfully.")
-            except Exception as e:
-                log.error(f"Failed to update config: {e}")
-                toast = Adw.Toast.new(f"❌ Error saving settings: {e}")
-                toast.set_timeout(3)
-                GLib.idle_add(self.toast_overlay.add_toast, toast)
-                GLib.idle_add(self.apply_btn.set_sensitive, True)
-                return
-            
-            # 2. Start or stop the guardian service
+                _, data, _ = file.load_contents_finish(res)
+            except GLib.Error as e:
+                if not e.matches(Gio.io_error_quark(), Gio.IOErrorEnum.NOT_FOUND):
+                    self._on_config_error(e.message)
+                    return
+                data = b""
+            new_data = self.merge_config(data, updates)
+            file.replace_contents_bytes_async(GLib.Bytes.new(new_data), None, False,
+                                              Gio.FileCreateFlags.NONE, None, on_written)
+
+        def on_written(file, res):
             try:
-                if guard_state:
-                    log.info("Restarting face-guardian.service...")
-                    subprocess.run(["systemctl", "--user", "restart", "face-guardian.service"], check=True)
-                    log.info("Service RESTART successful.")
-                else:
-                    log.info("Stopping face-guardian.service...")
-                    subprocess.run(["systemctl", "--user", "stop", "face-guardian.service"], check=False)
-                    log.info("Service STOP successful.")
-            except Exception as e:
-                log.error(f"Service error: {e}")
-            
-            # 3. Show success toast immediately
-            toast = Adw.Toast.new("✅ Settings Applied!")
-            toast.set_timeout(3)
-            GLib.idle_add(self.toast_overlay.add_toast, toast)
-            GLib.idle_add(self.apply_btn.set_sensitive, True)
-            log.info("================ END APPLY ===============")
+                file.replace_contents_finish(res)
+            except GLib.Error as e:
+                self._on_config_error(e.message)
+                return
+            log.info("Config file updated successfully.")
+            self._cfg_cache = None
+            self._apply_guardian_state(guard_state)
 
-        threading.Thread(target=task, daemon=True).start()
+        self.config_file.load_contents_async(None, on_loaded)
 
-    def run_pkexec_command(self, cmd_list):
+    @staticmethod
+    def merge_config(data, updates):
+        """Return config bytes with the keys in updates (all in _CFG_KEYS) set, keeping everything else."""
+        keys_written = set()
+
+        def replace(m):
+            key = m.group(2).decode()
+            keys_written.add(key)
+            return m.group(1) + f"{key} = {updates[key]}".encode()
+
+        data = _CFG_RE.sub(replace, data)
+        # Append any new keys that weren't in the file
+        missing = "".join(f"{key} = {val}\n" for key, val in updates.items() if key not in keys_written)
+        if missing:
+            if data and not data.endswith(b"\n"):
+                data += b"\n"
+            data += missing.encode()
+        return data
+
+    def _on_config_error(self, message):
+        log.error(f"Failed to update config: {message}")
+        toast = Adw.Toast.new(f"❌ Error saving settings: {message}")
+        toast.set_timeout(3)
+        self.toast_overlay.add_toast(toast)
+        self.apply_btn.set_sensitive(True)
+
+    def _apply_guardian_state(self, guard_state):
+        # 2. Start or stop the guardian service
+        action = "restart" if guard_state else "stop"
+        log.info(f"Running {action} on face-guardian.service...")
+
+        def on_service_done(ok, error):
+            if error:
+                log.error(f"Service error: {error}")
+            elif ok:
+                log.info(f"Service {action.upper()} successful.")
+            elif guard_state:
+                log.error("Service error: systemctl restart failed")
+            self._on_apply_done()
+        self._run_async(["systemctl", "--user", action, "face-guardian.service"], on_service_done)
+
+    def _on_apply_done(self):
+        # 3. Show success toast
+        toast = Adw.Toast.new("✅ Settings Applied!")
+        toast.set_timeout(3)
+        self.toast_overlay.add_toast(toast)
+        self.apply_btn.set_sensitive(True)
+        log.info("================ END APPLY ===============")
+
+    def run_pkexec_command(self, cmd_list, on_done):
+        """
+        Runs cmd_list through pkexec without blocking the main loop.
+        on_done(ok: bool) is called from the main loop when it exits.
+        """
         # Using pkexec so the user gets a secure system popup asking for password
         # when performing privileged actions (enrollment needs camera and to write to /etc/)
         log.debug(f"Attempting pkexec command: {cmd_list}")
+        # We explicitly need pkexec to spawn its graphical dialog
+        full_cmd = ["pkexec"] + cmd_list
+
+        # Set Wayland/X11 environment variables so pkexec apps can open Qt/GTK windows
+        # and so polkit knows which display to show the password prompt on
+        env = {k: os.environ[k] for k in PKEXEC_ENV_KEYS if k in os.environ}
+        env["XDG_RUNTIME_DIR"] = os.environ.get("XDG_RUNTIME_DIR", f"/run/user/{os.getuid()}")
+        env["DISPLAY"] = os.environ.get("DISPLAY", ":0")
+        log.debug(f"Environment for pkexec: DISPLAY={env['DISPLAY']}, "
+                  f"XDG_RUNTIME_DIR={env['XDG_RUNTIME_DIR']}")
+
+        def on_exit(ok, error):
+            if error:
+                log.error(f"Unexpected error executing pkexec command: {error}")
+            elif ok:
+                log.info(f"pkexec command successful: {cmd_list}")
+            else:
+                log.warning(f"pkexec failed (user likely canceled password prompt): {cmd_list}")
+            on_done(ok)
+        # No timeout needed: nothing blocks while the password dialog is up
+        self._run_async(full_cmd, on_exit, env)
+
+    def _run_async(self, argv, on_done, env=None):
+        """
+        Spawns argv and calls on_done(ok, error) from the main loop when it exits.
+        ok is whether it exited successfully; error is the GLib error message if it
+        couldn't be run at all, else None. env replaces the environment when given.
+        """
+        launcher = Gio.SubprocessLauncher.new(Gio.SubprocessFlags.NONE)
+        if env is not None:
+            launcher.set_environ([f"{k}={v}" for k, v in env.items()])
         try:
-            # We explicitly need pkexec to spawn its graphical dialog
-            full_cmd = ["pkexec"] + cmd_list
-            
-            # Set Wayland/X11 environment variables so pkexec apps can open Qt/GTK windows
-            # and so polkit knows which display to show the password prompt on
-            env = os.environ.copy()
-            uid = os.getuid()
-            if "XDG_RUNTIME_DIR" not in env:
-                env["XDG_RUNTIME_DIR"] = f"/run/user/{uid}"
-            if "DISPLAY" not in env:
-                env["DISPLAY"] = ":0"
-            
-            log.debug(f"Environment for pkexec: DISPLAY={env.get('DISPLAY')}, XDG_RUNTIME_DIR={env.get('XDG_RUNTIME_DIR')}")
-                
-            # Use timeout=30 to prevent the thread from blocking forever
-            # if the polkit dialog doesn't appear
-            result = subprocess.run(full_cmd, env=env, check=True, timeout=30)
-            log.info(f"pkexec command successful: {cmd_list}")
-            return True
-        except subprocess.TimeoutExpired:
-            log.warning(f"pkexec timed out after 30s (password dialog may not be visible): {cmd_list}")
-            return False
-        except subprocess.CalledProcessError as e:
-            log.warning(f"pkexec failed (user likely canceled password prompt): {e}")
-            return False
-        except Exception as e:
-            log.error(f"Unexpected error executing pkexec command: {e}")
-            return False
+            proc = launcher.spawnv(argv)
+        except GLib.Error as e:
+            on_done(False, e.message)
+            return
+
+        def on_exit(proc, res):
+            try:
+                proc.wait_finish(res)
+            except GLib.Error as e:
+                on_done(False, e.message)
+                return
+            on_done(proc.get_successful(), None)
+        proc.wait_async(None, on_exit)
 
 if __name__ == "__main__":
     app = FaceUnlockSettings()
@@ -38,6 +38,11 @@ for uid in $(ls /run/user/ 2>/dev/null); do
 done
 echo -e "  ${GREEN}✅${NC} Guardian stopped"
 
+# Stop the face engine daemon
+echo -e "\n${BOLD}▶ Stopping face engine daemon${NC}"
+systemctl disable --now face-unlockd.socket face-unlockd.service 2>/dev/null || true
+echo -e "  ${GREEN}✅${NC} Daemon stopped"
+
 # Remove installed files
 echo -e "\n${BOLD}▶ Removing installed files${NC}"
 rm -rf /usr/local/lib/face-unlock
@@ -49,7 +54,9 @@ rm -rf /usr/share/plymouth/themes/face-unlock
 rm -rf /usr/share/gnome-shell/extensions/face-unlock@face-unlock.ubuntu
 rm -f  /usr/share/polkit-1/actions/com.face-unlock.policy
 rm -f  /etc/systemd/user/face-guardian.service
-rm -f  /var/log/face-unlock.log
+rm -f  /etc/systemd/system/face-unlockd.socket /etc/systemd/system/face-unlockd.service
+rm -f  /run/face-unlock.sock
+rm -f  /var/log/face-unlock.log /var/log/face-unlock.log.[12]
 echo -e "  ${GREEN}✅${NC} Files removed"
 
 # Restore Plymouth theme